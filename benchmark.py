@@ -0,0 +1,191 @@
+"""
+Benchmarks for the performance options of the pipeline. Uses the dataset and model set in config.py
+    - "hashing":    compares the exact n-gram vocabulary with hashed feature spaces of 2^bits buckets
+                        e.g. python benchmark.py hashing --bits 14 16 18 20
+    - "sweep":      evaluates a grid of n_eval and penalty_p for HeLi with a single training run
+                        e.g. python benchmark.py sweep --n_eval 3 4 --penalties 5.0 5.8 6.6 --output sweep.csv
+    - "adaptive":   compares the number of sentences adaptive HeLi adopts per round (adoption_batch)
+                        e.g. python benchmark.py adaptive --k 1 10 100 0.01
+    - "stream":     streams the test set through the online mode of adaptive HeLi in micro-batches
+                        e.g. python benchmark.py stream --batch_size 1 100
+    - "preprocessing": compares removing symbols and stopwords with util.remove_from_sentence and the compiled
+                        filters on every dataset of config.datasets["datasets"]
+                        e.g. python benchmark.py preprocessing --sample 1000
+"""
+
+import argparse
+import copy
+import time
+import numpy as np
+import pandas as pd
+
+from config import Config
+from src.data.runner_dataset import get_dataset
+from src.models.runner_models import get_model
+from src.preprocessing.runner_preprocessing import get_preprocessing
+import src.utils.utils as util
+
+"""
+Trains and evaluates a model, returns the metrics of util.get_metrics plus train and test time
+"""
+def run_model(config: Config, dataset: object) -> dict:
+    model = get_model(config, dataset)
+    start = time.time()
+    model.train()
+    train_time = time.time() - start
+
+    X_test, Y_test = dataset.get_test_data()
+    start = time.time()
+    predictions = model.predict(X_test)
+    test_time = time.time() - start
+
+    metrics = util.get_metrics(Y_test, predictions, dataset.config["dialects"])
+    metrics["train_time"] = train_time
+    metrics["test_time"] = test_time
+    return metrics
+
+def hashing(args: argparse.Namespace, config: Config) -> None:
+    dataset = get_dataset(config.datasets, get_preprocessing(config))
+
+    # distinct training n-grams per order, used to compute the collision rates
+    X_train, _ = dataset.get_train_data()
+    vocabulary = util.NGramVocabulary()
+    util.extract_n_gram_ids(X_train['sentence_version'], config.model['n'], vocabulary)
+    n_grams = {n: [] for n in config.model['n']}
+    for n_gram in vocabulary.get_n_grams():
+        n_grams[len(n_gram)].append(n_gram)
+
+    exact_config = copy.deepcopy(config)
+    exact_config.model["hash_bits"] = 0
+    exact = run_model(exact_config, dataset)
+
+    print("\n{:<10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format("bits", "buckets", "collisions", "accuracy", "F1-score", "delta F1", "test time"))
+    print("{:<10} {:>10} {:>10} {:>10.4f} {:>10.4f} {:>10} {:>10.2f}".format("exact", len(vocabulary), "-", exact["accuracy"], exact["f1"], "-", exact["test_time"]))
+    for bits in args.bits:
+        hashed_config = copy.deepcopy(config)
+        hashed_config.model["hash_bits"] = bits
+        hashed = run_model(hashed_config, dataset)
+
+        hashed_vocabulary = util.HashedNGramVocabulary(bits)
+        collisions = sum(hashed_vocabulary.get_collision_rate(x) * len(x) for x in n_grams.values()) / max(len(vocabulary), 1)
+        print("{:<10} {:>10} {:>10.4f} {:>10.4f} {:>10.4f} {:>+10.4f} {:>10.2f}".format(bits, len(hashed_vocabulary), collisions, hashed["accuracy"], hashed["f1"], hashed["f1"] - exact["f1"], hashed["test_time"]))
+
+def sweep(args: argparse.Namespace, config: Config) -> None:
+    config.model["name"] = "HeLi"
+    dataset = get_dataset(config.datasets, get_preprocessing(config))
+    model = get_model(config, dataset)
+    model.train()
+
+    X_test, Y_test = dataset.get_test_data()
+    n_evals = args.n_eval if args.n_eval else config.model['n']
+    start = time.time()
+    results = model.sweep(X_test, Y_test, n_evals, args.penalties)
+    print("Evaluated {} configurations in {:.2f}s".format(len(results.index), time.time() - start))
+
+    with pd.option_context("display.max_rows", None):
+        print(results.sort_values(by="f1", ascending=False).to_string(index=False, float_format="{:.4f}".format))
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+def adaptive(args: argparse.Namespace, config: Config) -> None:
+    config.model["name"] = "adaptive_HeLi"
+    dataset = get_dataset(config.datasets, get_preprocessing(config))
+    trained_model = get_model(config, dataset)
+    trained_model.train()
+    X_test, Y_test = dataset.get_test_data()
+
+    results = []
+    for k in args.k:
+        # every run adapts its own copy of the trained model, the dataset is shared and not copied
+        model = copy.deepcopy(trained_model, {id(dataset): dataset})
+        model.config["adoption_batch"] = k
+        start = time.time()
+        predictions = model.predict(X_test)
+        wall_time = time.time() - start
+        metrics = util.get_metrics(Y_test, predictions, dataset.config["dialects"])
+        results.append((k, model.get_adoption_batch_size(len(X_test.index)), wall_time, metrics))
+
+    print("\n{:<10} {:>10} {:>10} {:>10} {:>10}".format("k", "per round", "time", "accuracy", "F1-score"))
+    for k, batch_size, wall_time, metrics in results:
+        print("{:<10} {:>10} {:>10.2f} {:>10.4f} {:>10.4f}".format(k, batch_size, wall_time, metrics["accuracy"], metrics["f1"]))
+
+def stream(args: argparse.Namespace, config: Config) -> None:
+    config.model["name"] = "adaptive_HeLi"
+    dataset = get_dataset(config.datasets, get_preprocessing(config))
+    model = get_model(config, dataset)
+    model.train()
+    X_test, Y_test = dataset.get_test_data()
+
+    static = X_test['sentence_version'].apply(lambda x: model.predict_dialect({'sentence_version': x}, config.model["n_eval"]))
+    static_f1 = util.get_metrics(Y_test, static, dataset.config["dialects"])["f1"]
+
+    print("\n{:<10} {:>12} {:>10} {:>10} {:>10} {:>10}".format("batch", "sentences/s", "adopted", "adapted", "F1-score", "delta F1"))
+    for batch_size in args.batch_size:
+        model.reset_online()
+        start = time.time()
+        predictions = [prediction for prediction, _ in model.predict_stream(X_test['sentence_version'], batch_size)]
+        wall_time = time.time() - start
+        predictions = pd.Series(predictions, X_test.index)
+        f1 = util.get_metrics(Y_test, predictions, dataset.config["dialects"])["f1"]
+        adapted = sum(len(n_grams) for orders in model.adapted.values() for n_grams in orders.values())
+        print("{:<10} {:>12.1f} {:>10} {:>10} {:>10.4f} {:>+10.4f}".format(batch_size, len(predictions.index) / wall_time, model.online_step, adapted, f1, f1 - static_f1))
+
+def preprocessing(args: argparse.Namespace, config: Config) -> None:
+    preprocessor = get_preprocessing(config)
+    print("\n{:<20} {:>10} {:<12} {:>10} {:>10} {:>10}".format("dataset", "sentences", "step", "loops", "compiled", "speedup"))
+    for dataset_config in config.datasets["datasets"]:
+        try:
+            data = get_dataset(dataset_config).data
+        except NotImplementedError:
+            print("{:<20} skipped, raw data not found".format(dataset_config["name"]))
+            continue
+        sentences = data['sentence_version']
+        symbols = config.preprocessing["symbols_to_remove"]
+
+        start = time.time()
+        expected = sentences.apply(lambda x: util.remove_from_sentence(x, symbols))
+        loops = time.time() - start
+        start = time.time()
+        filtered = util.filter_symbols(sentences, util.compile_symbol_filter(symbols))
+        compiled = time.time() - start
+        assert filtered.equals(expected)
+        print("{:<20} {:>10} {:<12} {:>10.3f} {:>10.3f} {:>9.1f}x".format(dataset_config["name"], len(sentences.index), "symbols", loops, compiled, loops / compiled))
+
+        # the loops scan every sentence once per stopword, they are timed on a sample and extrapolated
+        stopwords = preprocessor.get_stop_words(data.assign(sentence_version=filtered))
+        sample = filtered.iloc[:args.sample]
+        start = time.time()
+        sample.apply(lambda x: util.remove_from_sentence(x, stopwords))
+        loops = (time.time() - start) * len(filtered.index) / max(len(sample.index), 1)
+        start = time.time()
+        util.filter_tokens(filtered, set(stopwords))
+        compiled = time.time() - start
+        print("{:<20} {:>10} {:<12} {:>10.3f} {:>10.3f} {:>9.1f}x".format(dataset_config["name"], len(sentences.index), "stopwords", loops, compiled, loops / compiled))
+
+"""
+Parses the adoption batch sizes: integers are counts, numbers below 1 fractions of the test set
+"""
+def adoption_batch(value: str) -> object:
+    return float(value) if "." in value else int(value)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=["hashing", "sweep", "adaptive", "stream", "preprocessing"], help="Benchmark to run")
+    parser.add_argument("--bits", type=int, nargs="+", default=[14, 16, 18, 20], help="Hash sizes for the 'hashing' benchmark")
+    parser.add_argument("--n_eval", type=int, nargs="+", help="Values of n_eval for the 'sweep' benchmark, defaults to all n of the model")
+    parser.add_argument("--penalties", type=float, nargs="+", default=np.round(np.arange(4.0, 8.01, 0.2), 1).tolist(), help="Values of penalty_p for the 'sweep' benchmark")
+    parser.add_argument("--output", "-o", type=str, help="Path of a csv file the results of the 'sweep' benchmark are written to")
+    parser.add_argument("--k", type=adoption_batch, nargs="+", default=[1, 10, 100, 0.01, 0.05], help="Adoption batch sizes for the 'adaptive' benchmark")
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[1, 10, 100], help="Micro-batch sizes for the 'stream' benchmark")
+    parser.add_argument("--sample", type=int, default=1000, help="Number of sentences the stopword loops are timed on in the 'preprocessing' benchmark")
+    args = parser.parse_args()
+    if args.benchmark == "hashing":
+        hashing(args, Config())
+    elif args.benchmark == "sweep":
+        sweep(args, Config())
+    elif args.benchmark == "adaptive":
+        adaptive(args, Config())
+    elif args.benchmark == "stream":
+        stream(args, Config())
+    elif args.benchmark == "preprocessing":
+        preprocessing(args, Config())
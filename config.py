@@ -5,10 +5,24 @@ class Config():
             "n": [1,2,3,4],
             "n_eval": 4,
             "penalty_p": 5.8,
-            "n_dialects": 4
+            "n_dialects": 4,
+            "compiled": True,
+            "cache_size": 100000,
+            "hash_bits": 0,
+            "n_workers": 1,
+            "model_cache_size": 10,
+            "min_count": 1,
+            "max_features": 0,
+            "cutoff": 0.9,
+            "adoption_batch": 1,
+            "online_threshold": 0.5,
+            "online_decay": 0.9999,
+            "online_max_ngrams": 100000,
+            "online_min_count": 0.5
         }
         self.datasets = {
             "name": "gdi-vardial-2017",
+            "raw_data_path": "data/raw/gdi-vardial-2017/combined.txt",
             "split": 0.2,
             "dialects": ["ch_bs", "ch_lu", "ch_be", "ch_zh"],
             "datasets": [
@@ -46,6 +60,7 @@ class Config():
             "no_load": True,
             "n": [1,2,3,4],
             "symbols_to_remove": ['"', '«', '»', '.', ',', '?', '!', '(', ')', '[', ']', '&'],
+            "stopwords_method": "total",
             "stopwords_threshold_total": 200,
             "stopwords_threshold_tf_idf": 0.09
         }
@@ -63,7 +78,31 @@ self.model defines which model to use:
     "n_eval":       Size of n-gram used for evaluation. Must be of type int
     "penalty_p":    Specific value for (adaptive) Heli-model. Penalty added if no n-gram of word present (c.f. eq. 6 in Heli paper)
     "cutoff":       Specific value for adaptive HeLi-model. Number between 0 and 1 setting the proportion of data predicted with normal HeLi
+    "adoption_batch": Specific value for adaptive HeLi-model. Number of most confident predictions adopted per round before
+                        rescoring. An int is a count, a float below 1 a fraction of the test set
+    "online_threshold": Specific value for adaptive HeLi-model in online mode (predict_stream). Minimum confidence of a
+                        prediction to adapt the counts with its sentence
+    "online_decay": Specific value for adaptive HeLi-model in online mode. Factor the adapted counts decay by per adopted
+                        sentence. 1 disables the decay
+    "online_max_ngrams": Specific value for adaptive HeLi-model in online mode. Maximum number of adapted n-grams per dialect
+                        and order, the least recently adapted ones are evicted first
+    "online_min_count": Specific value for adaptive HeLi-model in online mode. Adapted counts that decayed below this value
+                        are removed, such that stale adaptations do not score worse than unseen n-grams. 0 keeps them
     "n_dialects":   number of dialects in the chosen dataset
+    "compiled":     Specific value for Heli-model. If set to true, the scores are compiled into matrices after training
+                        and the whole test set is scored at once. Must be of type bool
+    "cache_size":   Specific value for (adaptive) Heli-model. Maximum number of (word, n) entries kept in the LRU cache of
+                        per-dialect word scores. 0 disables the cache
+    "hash_bits":    Specific value for Heli- and SVM-model. If set to k > 0, n-grams are hashed into a fixed space of 2^k buckets
+                        per n-gram order instead of using the exact vocabulary. 0 uses the exact vocabulary. Must be of type int
+    "n_workers":    Number of processes counting n-grams during training of the (adaptive) Heli-model, training the
+                        per dialect models of the SVM-model and predicting the test set with the Heli- and SVM-model. 1 runs in the main process, 0 uses all cores. Must be of type int
+    "model_cache_size": Specific value for SVM-model. Number of trained configurations kept in models/, the least recently used
+                        ones are removed. 0 keeps all. Must be of type int
+    "min_count":    Specific value for SVM-model. Minimum number of training sentences an n-gram must occur in to become a feature.
+                        An int for all n-gram orders or a list with a value per order in "n"
+    "max_features": Specific value for SVM-model. Maximum number of features per n-gram order, the most frequent n-grams are kept.
+                        0 keeps all. An int for all n-gram orders or a list with a value per order in "n"
 
 self.datasets defines which dataset(s) to use:
     "name":          Name of the dataset, matched in /data/runner_dataset.py
@@ -89,10 +128,14 @@ self.preprocessing defines which preprocesser to use:
             - "balance"             -> removes all senteces that are not available in all dialects ('balance'). Only works for SwissDial
             - "removeStopWords"     -> removes stop words ('remove_stop_words'). Depends on "stopwords_threshold_total"
                                             and "stopwords_threshold_tf_idf". UNTESTED
-    "processed_data_path":  Path were processed parts of dataset are stored
-    "no_store":             If set to false, preprocessed data will not be stored. Must be of type bool
+    "processed_data_path":  Path were processed datasets are cached. Every entry is keyed by a hash of the raw data and the
+                            preprocessing config and stores the data including the n-gram ids as npz
+    "no_store":             If set to true, preprocessed data will not be stored. Must be of type bool
+    "no_load":              If set to true, preprocessed data will not be loaded from the cache. Must be of type bool
     "n":                    Size of n-grams creates if 'nGrams' is set. Must be of type list
     "symbols_to_remove":    List of symbols that are removed if 'removeSymbols' is set. Must be of type list
-    "stopwords_threshold_total": 
-    "stopwords_threshold_df_idf":
+    "stopwords_method":     Method used to find stopwords if 'removeStopWords' is set, "total" or "tfidf". Stopword lists are cached
+                            per dataset and config in processed_data_path
+    "stopwords_threshold_total": Words with a total frequency of at most this value are stopwords (method "total")
+    "stopwords_threshold_tf_idf": Words with a tf-idf of at most this value in any dialect are stopwords (method "tfidf")
 """
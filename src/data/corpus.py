@@ -0,0 +1,180 @@
+"""
+Compact columnar in-memory representation of a (preprocessed) dataset
+"""
+
+import re
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from typing import Tuple
+
+import src.utils.utils as util
+
+"""
+Holds the rows of a dataset in flat arrays instead of a DataFrame with a Python object per cell:
+    - the dialects as int8 codes into dialect_names
+    - the sentences as one contiguous utf-8 buffer with offsets, sentence i is buffer[offsets[i]:offsets[i+1]]
+    - the n-grams of every order as CSR-style (offsets, ids) arrays into one shared array of n-gram strings, the
+      ids use the smallest unsigned integer type that fits the number of distinct n-grams
+    - all other columns as numpy arrays
+DataFrames with the columns of the original frame are built on demand for any subset of rows (to_frame)
+"""
+class Corpus():
+    """
+    Builds the corpus from data. The n-grams are either given as the array of n-gram strings plus the (offsets, ids)
+    per n of util.extract_n_gram_ids, then they are added as the columns '{n}_grams' after the columns of data, or
+    taken from the '{n}_grams' columns of data holding a list of n-grams per row
+    """
+    def __init__(self, data: pd.DataFrame, n_grams: np.ndarray=None, n_gram_ids: dict=None) -> None:
+        self.columns = data.columns.tolist()
+        self.index = data.index.to_numpy(copy=True)
+
+        if 'dialect' in data.columns:
+            codes, names = pd.factorize(data['dialect'])
+            if len(names) > np.iinfo(np.int8).max:
+                print("Too many dialects for int8 codes. Aborting")
+                raise NotImplementedError
+            self.dialect_codes = codes.astype(np.int8)
+            self.dialect_names = np.asarray(names, dtype=object)
+
+        if 'sentence_version' in data.columns:
+            encoded = [sentence.encode() for sentence in data['sentence_version']]
+            self.sentence_offsets = np.concatenate([[0], np.cumsum([len(sentence) for sentence in encoded], dtype=np.int64)])
+            self.sentence_buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        if n_gram_ids is None:
+            # n-gram lists are mapped to ids in a single vocabulary shared by all orders
+            vocabulary = util.NGramVocabulary()
+            n_gram_ids = {}
+            for column in self.columns:
+                if re.fullmatch(r'\d+_grams', column):
+                    n_grams_per_row = data[column].tolist()
+                    ids = np.fromiter((vocabulary.add(n_gram) for n_grams in n_grams_per_row for n_gram in n_grams), dtype=np.int64)
+                    offsets = np.concatenate([[0], np.cumsum([len(n_grams) for n_grams in n_grams_per_row], dtype=np.int64)])
+                    n_gram_ids[int(column.split('_')[0])] = (offsets, ids)
+            n_grams = vocabulary.get_n_grams()
+        else:
+            self.columns += [f'{n}_grams' for n in n_gram_ids]
+        # the ids are stored in the smallest unsigned type that holds them
+        self.n_grams = np.asarray(n_grams, dtype=object)
+        id_type = np.min_scalar_type(max(len(self.n_grams) - 1, 0))
+        self.n_gram_ids = {n: (np.asarray(offsets, dtype=np.int64), ids.astype(id_type)) for n, (offsets, ids) in n_gram_ids.items()}
+
+        self.other_columns = {column: data[column].to_numpy(copy=True) for column in data.columns if column not in ['dialect', 'sentence_version'] and not re.fullmatch(r'\d+_grams', column)}
+
+        # the corpus is immutable, splits and models only ever read from it
+        for array in self.get_arrays():
+            array.setflags(write=False)
+        self.frames = util.LRUCache(2)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get_dialects(self, rows: np.ndarray) -> np.ndarray:
+        return self.dialect_names[self.dialect_codes[rows]]
+
+    def get_sentences(self, rows: np.ndarray) -> list:
+        buffer = self.sentence_buffer.tobytes()
+        starts, ends = self.sentence_offsets[rows], self.sentence_offsets[rows + 1]
+        return [buffer[start:end].decode() for start, end in zip(starts.tolist(), ends.tolist())]
+
+    def get_n_gram_lists(self, n: int, rows: np.ndarray) -> list:
+        offsets, ids = self.n_gram_ids[n]
+        starts, ends = offsets[rows], offsets[rows + 1]
+        return [self.n_grams[ids[start:end]].tolist() for start, end in zip(starts.tolist(), ends.tolist())]
+
+    """
+    Builds a DataFrame of the given rows (positions, all if None) with the given columns (all if None) in the
+    column order and with the index of the original frame
+    """
+    def to_frame(self, rows: np.ndarray=None, columns: list=None) -> pd.DataFrame:
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        columns = self.columns if columns is None else columns
+        values = {}
+        for column in columns:
+            if column == 'dialect':
+                values[column] = self.get_dialects(rows)
+            elif column == 'sentence_version':
+                values[column] = self.get_sentences(rows)
+            elif column in self.other_columns:
+                values[column] = self.other_columns[column][rows]
+            else:
+                values[column] = self.get_n_gram_lists(int(column.split('_')[0]), rows)
+        return pd.DataFrame(values, index=self.index[rows], columns=columns)
+
+    """
+    Returns a corpus of the given rows (positions) and columns. The n-gram ids are gathered from the arrays, the
+    n-gram columns are placed last
+    """
+    def select(self, rows: np.ndarray, columns: list) -> 'Corpus':
+        rows = np.asarray(rows, dtype=np.int64)
+        n_gram_columns = [column for column in columns if re.fullmatch(r'\d+_grams', column)]
+        data = self.to_frame(rows, [column for column in columns if column not in n_gram_columns])
+        n_gram_ids = {}
+        for column in n_gram_columns:
+            n = int(column.split('_')[0])
+            offsets, ids = self.n_gram_ids[n]
+            starts, lengths = offsets[rows], offsets[rows + 1] - offsets[rows]
+            selected_offsets = np.concatenate([[0], np.cumsum(lengths)])
+            positions = np.repeat(starts - selected_offsets[:-1], lengths) + np.arange(selected_offsets[-1])
+            n_gram_ids[n] = (selected_offsets, ids[positions])
+        return Corpus(data, self.n_grams, n_gram_ids)
+
+    """
+    Splits the rows like sklearn's train_test_split of the full frames did and returns the positions (train, test)
+    """
+    def split(self, test_size: float, random_state: int=42) -> Tuple[np.ndarray, np.ndarray]:
+        return train_test_split(np.arange(len(self)), test_size=test_size, random_state=random_state)
+
+    """
+    Returns the features (all columns but the dialect) and the targets of the given rows. The frames of the two most
+    recently used row sets (the train and the test split) are built once and shared: every caller gets shallow copies,
+    thus adding, dropping or replacing columns does not affect other callers. Cell values are shared and must not be
+    modified in place
+    """
+    def get_data(self, rows: np.ndarray) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        key = np.asarray(rows, dtype=np.int64).tobytes()
+        frames = self.frames.get(key)
+        if frames is None:
+            frames = (self.to_frame(rows, [column for column in self.columns if column != 'dialect']), self.to_frame(rows, ['dialect']))
+            self.frames.put(key, frames)
+        return frames[0].copy(deep=False), frames[1].copy(deep=False)
+
+    def get_arrays(self) -> list:
+        arrays = [self.index, self.n_grams] + list(self.other_columns.values())
+        for name in ['dialect_codes', 'dialect_names', 'sentence_offsets', 'sentence_buffer']:
+            if hasattr(self, name):
+                arrays.append(getattr(self, name))
+        for offsets, ids in self.n_gram_ids.values():
+            arrays += [offsets, ids]
+        return arrays
+
+    """
+    Returns the number of bytes held by the arrays, including the n-gram strings
+    """
+    def nbytes(self) -> int:
+        n_gram_strings = sum(len(n_gram.encode()) for n_gram in self.n_grams.tolist())
+        return sum(array.nbytes for array in self.get_arrays()) + n_gram_strings
+
+"""
+Base of the dataset classes: holds the rows of the dataset in self.corpus and the train and test split as row
+positions into it. The dataset sets self.config with the "split" and assigns the loaded data to self.data
+"""
+class CorpusDataset():
+    # the rows are held in a compact Corpus, DataFrames are built from it on demand
+    @property
+    def data(self) -> pd.DataFrame:
+        return self.corpus.to_frame()
+
+    @data.setter
+    def data(self, data: pd.DataFrame) -> None:
+        self.corpus = Corpus(data)
+
+    def test_train_split(self) -> None:
+        self.train_rows, self.test_rows = self.corpus.split(self.config["split"], random_state=42)
+
+    def get_train_data(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        return self.corpus.get_data(self.train_rows)
+
+    def get_test_data(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        return self.corpus.get_data(self.test_rows)
@@ -3,10 +3,12 @@ Implementation of the gdi-vardial datasets
 """
 
 import pandas as pd
-from sklearn.model_selection import train_test_split
 from typing import Tuple
 
-class GdiVardial():
+from src.data.corpus import CorpusDataset
+import src.utils.utils as util
+
+class GdiVardial(CorpusDataset):
     # maps dialects used in gdi-vardial to SwissDial format
     dialect_mapping = {
         "LU": "ch_lu",
@@ -22,35 +24,54 @@ class GdiVardial():
 
         self.load_data()
         if preprocessing is not None:
-            self.data = self.preprocessing.preprocess(raw_data=self.data, datasetname=self.config["name"])
+            self.corpus = self.preprocessing.preprocess_corpus(raw_data=self.data, datasetname=self.config["name"])
         self.test_train_split()
 
+    """
+    Loads the corpus from the parsed-corpus cache next to the raw file, or parses the raw file and creates the cache.
+    The cache holds all dialects, the ones not in config["dialects"] are removed after loading
+    """
     def load_data(self) -> None:
-        try:
-            rows = []
-            with open(self.config["raw_data_path"], 'r') as f:
-                lines = f.readlines()
-            for line in lines:
-                splitted_line = line.rsplit("\t", 1)
-                sentence = splitted_line[0]
-                dialect = splitted_line[1].replace("\n", "")
-                dialect = GdiVardial.dialect_mapping[splitted_line[1].replace("\n", "")]
-                if not dialect in self.config["dialects"]:
-                    continue
-                rows.append([dialect, sentence])
-            self.n_rows = len(rows)
-            self.data = pd.DataFrame(rows, columns=['dialect', 'sentence_version'])
-        except:
-            print("Dataset not found, invalid path. Abort")
-            raise NotImplementedError
+        data = util.load_parsed_corpus(self.config["raw_data_path"])
+        if data is None:
+            try:
+                with open(self.config["raw_data_path"], 'r') as f:
+                    rows = [GdiVardial.parse_line(line) for line in f]
+            except:
+                print("Dataset not found, invalid path. Abort")
+                raise NotImplementedError
+            data = pd.DataFrame(rows, columns=['dialect', 'sentence_version'])
+            util.store_parsed_corpus(self.config["raw_data_path"], data)
+        self.data = data[data['dialect'].isin(self.config["dialects"])].reset_index(drop=True)
+        self.n_rows = len(self.corpus)
 
-    def test_train_split(self) -> None:
-        df_X = self.data.drop(labels=['dialect'], axis=1, inplace=False)
-        df_Y = self.data[['dialect']]
-        self.X_train, self.X_test, self.Y_train, self.Y_test = train_test_split(df_X, df_Y, test_size=self.config["split"], random_state=42)
+    """
+    Gets a line of the raw file and returns the pair (dialect, sentence)
+    """
+    @staticmethod
+    def parse_line(line: str) -> Tuple[str, str]:
+        splitted_line = line.rsplit("\t", 1)
+        sentence = splitted_line[0]
+        dialect = GdiVardial.dialect_mapping[splitted_line[1].replace("\n", "")]
+        return dialect, sentence
 
-    def get_train_data(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        return self.X_train, self.Y_train
-
-    def get_test_data(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        return self.X_test, self.Y_test
\ No newline at end of file
+    """
+    Streams the raw file line by line and yields lists of at most batch_size (dialect, sentence) pairs.
+    Dialects not in dataset_config["dialects"] are skipped while parsing. Does not load the whole corpus,
+    e.g. Heli.partial_fit can consume the batches after preprocessing the sentences
+    """
+    @staticmethod
+    def iter_data(dataset_config: dict, batch_size: int=10000):
+        dialects = set(dataset_config["dialects"])
+        batch = []
+        with open(dataset_config["raw_data_path"], 'r') as f:
+            for line in f:
+                dialect, sentence = GdiVardial.parse_line(line)
+                if dialect not in dialects:
+                    continue
+                batch.append((dialect, sentence))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
\ No newline at end of file
@@ -3,9 +3,8 @@ This file loads the dataset that is specified in the configuration
 """
 
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from typing import Tuple
 
+from src.data.corpus import CorpusDataset
 from src.data.swissdial import SwissDial
 from src.data.gdi_vardial import GdiVardial
 
@@ -24,7 +23,7 @@ def get_dataset(dataset_config: dict, preprocessing: object=None) -> object:
 """
 Wrapper class to handle multiple datasets
 """
-class MultipleDatasets():
+class MultipleDatasets(CorpusDataset):
     def __init__(self, config: dict, preprocessing:object) -> None:
         self.config = config
         self.datasets = []
@@ -45,17 +44,6 @@ class MultipleDatasets():
 
         if self.config["no_individual_preprocessing"]:
             # Preprocess data if not already done
-            self.data = preprocessing.preprocess(raw_data=self.data, datasetname=name)
+            self.corpus = preprocessing.preprocess_corpus(raw_data=self.data, datasetname=name)
 
-        self.test_train_split()
-
-    def test_train_split(self) -> None:
-        df_X = self.data.drop(labels=['dialect'], axis=1, inplace=False)
-        df_Y = self.data[['dialect']]
-        self.X_train, self.X_test, self.Y_train, self.Y_test = train_test_split(df_X, df_Y, test_size=self.config["split"], random_state=42)
-
-    def get_train_data(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        return self.X_train, self.Y_train
-
-    def get_test_data(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        return self.X_test, self.Y_test
\ No newline at end of file
+        self.test_train_split()
\ No newline at end of file
@@ -3,52 +3,77 @@ Implementation of the Swiss Dial dataset
 """
 
 import json
+import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from typing import Tuple
 
-class SwissDial():
+from src.data.corpus import CorpusDataset
+import src.utils.utils as util
+
+class SwissDial(CorpusDataset):
     def __init__(self, dataset_config: dict, preprocessing: object) -> None:
         self.config = dataset_config
         self.preprocessing = preprocessing
 
         self.load_data()
         if preprocessing is not None:
-            self.data = self.preprocessing.preprocess(raw_data=self.data, datasetname=self.config["name"])
+            self.corpus = self.preprocessing.preprocess_corpus(raw_data=self.data, datasetname=self.config["name"])
         self.remove_unused()
         self.test_train_split()
 
     def remove_unused(self) -> None:
-        self.data.drop(self.data.index[~self.data['dialect'].isin(self.config["dialects"])], inplace=True)
-        self.data.drop(labels=['sentence_id', 'topic', 'code_switching'], axis=1, inplace=True)
+        rows = np.flatnonzero(np.isin(self.corpus.get_dialects(np.arange(len(self.corpus))), self.config["dialects"]))
+        columns = [column for column in self.corpus.columns if column not in ['sentence_id', 'topic', 'code_switching']]
+        self.corpus = self.corpus.select(rows, columns)
 
+    """
+    Loads the corpus from the parsed-corpus cache next to the raw file, or parses the raw file and creates the cache
+    """
     def load_data(self) -> None:
-        try:
-            with open(self.config["raw_data_path"], 'r') as json_f:
-                json_dataset = json.load(json_f)
-        except FileNotFoundError:
-            print("Dataset not found, invalid path. Abort")
-            raise NotImplementedError
-        rows = []
-        for sentence_set in json_dataset:
-            id = sentence_set.pop('id')
-            topic = sentence_set.pop('thema')
-            code_switching = sentence_set.pop('code_switching', False)
-
-            for key, val in sentence_set.items():
-                rows.append([id, key, val, topic, code_switching])
-        
-        self.n_rows = len(rows)
-        
-        self.data = pd.DataFrame(rows, columns=['sentence_id', 'dialect', 'sentence_version', 'topic', 'code_switching'])
-
-    def test_train_split(self) -> None:
-        df_X = self.data.drop(labels=['dialect'], axis=1, inplace=False)
-        df_Y = self.data[['dialect']]
-        self.X_train, self.X_test, self.Y_train, self.Y_test = train_test_split(df_X, df_Y, test_size=self.config["split"], random_state=42)
-
-    def get_train_data(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        return self.X_train, self.Y_train
-
-    def get_test_data(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        return self.X_test, self.Y_test
\ No newline at end of file
+        data = util.load_parsed_corpus(self.config["raw_data_path"])
+        if data is None:
+            try:
+                with open(self.config["raw_data_path"], 'r') as json_f:
+                    json_dataset = json.load(json_f)
+            except FileNotFoundError:
+                print("Dataset not found, invalid path. Abort")
+                raise NotImplementedError
+            rows = []
+            for sentence_set in json_dataset:
+                rows += SwissDial.parse_sentence_set(sentence_set)
+            data = pd.DataFrame(rows, columns=['sentence_id', 'dialect', 'sentence_version', 'topic', 'code_switching'])
+            util.store_parsed_corpus(self.config["raw_data_path"], data)
+
+        self.data = data
+        self.n_rows = len(self.corpus)
+
+    """
+    Gets a sentence set of the raw corpus and returns a row [id, dialect, sentence, topic, code_switching] per dialect
+    """
+    @staticmethod
+    def parse_sentence_set(sentence_set: dict) -> list:
+        sentence_set = dict(sentence_set)
+        id = sentence_set.pop('id')
+        topic = sentence_set.pop('thema')
+        code_switching = sentence_set.pop('code_switching', False)
+        return [[id, key, val, topic, code_switching] for key, val in sentence_set.items()]
+
+    """
+    Streams the JSON corpus sentence set by sentence set and yields lists of at most batch_size (dialect, sentence)
+    pairs. Dialects not in dataset_config["dialects"] are skipped while parsing. Does not load the whole corpus,
+    e.g. Heli.partial_fit can consume the batches after preprocessing the sentences
+    """
+    @staticmethod
+    def iter_data(dataset_config: dict, batch_size: int=10000):
+        dialects = set(dataset_config["dialects"])
+        batch = []
+        with open(dataset_config["raw_data_path"], 'r') as json_f:
+            for sentence_set in util.iter_json_array(json_f):
+                for _, dialect, sentence, _, _ in SwissDial.parse_sentence_set(sentence_set):
+                    if dialect not in dialects:
+                        continue
+                    batch.append((dialect, sentence))
+                    if len(batch) == batch_size:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
\ No newline at end of file
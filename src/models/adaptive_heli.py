@@ -2,10 +2,15 @@
 Implementation of the Heli model
 """
 
-from math import log10
+from collections import OrderedDict
+import heapq
+from itertools import islice
+from math import floor, inf, log, log10
 from tokenize import String
+import numpy as np
 from numpy import NaN
 import pandas as pd
+from scipy import sparse
 from typing import Tuple
 
 
@@ -15,35 +20,87 @@ class adaptive_Heli():
     def __init__(self, config: dict, dataset: object) -> None:
         self.config = config
         self.dataset = dataset
-        self.state = {}
-        for dialect in self.dataset.config['dialects']:
-            self.state[dialect] = {}
-            for n in self.config['n']:
-                self.state[dialect][f'{n}_grams'] = {}
+        # scores are computed lazily as -log10(count/num_ngrams) from the raw counts and the
+        # number of n-grams per dialect and order, thus updates only touch the adopted n-grams
         self.counts = {}
+        self.num_ngrams = {}
         for dialect in self.dataset.config['dialects']:
             self.counts[dialect] = {}
+            self.num_ngrams[dialect] = {}
             for n in self.config['n']:
                 self.counts[dialect][f'{n}_grams'] = {}
+                self.num_ngrams[dialect][f'{n}_grams'] = 0
+        self.word_cache = util.LRUCache(self.config.get("cache_size", 0))
+        self.reset_online()
+
+    """
+    Clears the adapted counts of the online mode (see predict_stream). The trained counts are kept
+    """
+    def reset_online(self) -> None:
+        # adapted counts are an overlay {dialect: {nstring: OrderedDict(n_gram -> [count, step])}} on top of the
+        # trained counts, ordered from least to most recently adapted. num_adapted counts the adapted n-grams
+        # missing from the trained counts, which add to the number of n-grams of the dialect. expiring is a heap of
+        # (step, dialect, nstring, n_gram) at which an adapted count decays below online_min_count unless it is
+        # adapted again before
+        self.adapted = {}
+        self.num_adapted = {}
+        for dialect in self.dataset.config['dialects']:
+            self.adapted[dialect] = {f'{n}_grams': OrderedDict() for n in self.config['n']}
+            self.num_adapted[dialect] = {f'{n}_grams': 0 for n in self.config['n']}
+        self.expiring = []
+        self.online_step = 0
+        self.word_cache.clear()
 
     def count_ngrams(self, row: dict) -> None:
         dialect = row['dialect']
         for n in self.config['n']:
             nstring = f'{n}_grams'
             for ngram in row[nstring]:
-                if self.state[dialect][nstring].get(ngram) == None:
-                    self.state[dialect][nstring][ngram] = 1
+                if self.counts[dialect][nstring].get(ngram) == None:
+                    self.counts[dialect][nstring][ngram] = 1
                 else:
-                    self.state[dialect][nstring][ngram] += 1
+                    self.counts[dialect][nstring][ngram] += 1
+
+    """
+    Adds the n-gram counts of a batch of sentences given as CSR-style id arrays
+    (see util.extract_n_gram_ids) to the count tables
+    """
+    def count_n_gram_ids(self, dialects: list, n_gram_ids: dict, vocabulary: object) -> None:
+        self.add_counts(util.count_n_gram_ids(dialects, n_gram_ids, vocabulary, list(self.counts.keys())))
+
+    """
+    Merges count tables as returned by util.count_n_grams into the count tables of the model
+    """
+    def add_counts(self, tables: dict) -> None:
+        for dialect, orders in tables.items():
+            for n, (keys, counts) in orders.items():
+                table = self.counts[dialect][f'{n}_grams']
+                for ngram, count in zip(keys.tolist(), counts.tolist()):
+                    table[ngram] = table.get(ngram, 0) + count
 
     def get_v_values(self) -> None:
         for dialect in self.dataset.config['dialects']:
             for n in self.config['n']:
                 nstring = f'{n}_grams'
-                num_ngrams = len(self.state[dialect][nstring].keys())
-                for ngram, count in self.state[dialect][nstring].items():
-                    self.state[dialect][nstring][ngram] = -log10(count/num_ngrams)
-                    self.counts[dialect][nstring][ngram] = count
+                self.num_ngrams[dialect][nstring] = len(self.counts[dialect][nstring].keys())
+        self.word_cache.clear()
+
+    """
+    Returns the trained count of an n-gram plus its adapted count decayed by online_decay per adopted sentence.
+    Adapted counts below online_min_count are removed by adapt_online, thus every adapted n-gram counts
+    """
+    def get_count(self, n_gram: str, nstring: str, dialect: str) -> float:
+        count = self.counts[dialect][nstring].get(n_gram, 0)
+        adapted = self.adapted[dialect][nstring].get(n_gram)
+        if adapted is not None:
+            count += adapted[0] * self.config.get("online_decay", 1.0) ** (self.online_step - adapted[1])
+        return count
+
+    def get_num_ngrams(self, nstring: str, dialect: str) -> int:
+        return self.num_ngrams[dialect][nstring] + self.num_adapted[dialect][nstring]
+
+    def get_score(self, n_gram: str, nstring: str, dialect: str) -> float:
+        return -log10(self.get_count(n_gram, nstring, dialect) / self.get_num_ngrams(nstring, dialect))
 
 
     """
@@ -51,9 +108,15 @@ class adaptive_Heli():
     """
     def train(self) -> None:
         X_train, Y_train = self.dataset.get_train_data()
-        X_train.insert(0, 'dialect', Y_train.squeeze())
-        df = X_train
-        df.apply(lambda x: self.count_ngrams(x), axis=1)
+        n_workers = self.config.get("n_workers", 1)
+        if n_workers == 1:
+            vocabulary = util.NGramVocabulary()
+            n_gram_ids = util.extract_n_gram_ids(X_train['sentence_version'], self.config['n'], vocabulary)
+            self.count_n_gram_ids(Y_train['dialect'], n_gram_ids, vocabulary)
+        else:
+            tables = util.count_n_grams_parallel(Y_train['dialect'].tolist(), X_train['sentence_version'].tolist(), self.config['n'], list(self.counts.keys()), n_workers=n_workers)
+            for shard_tables in tables:
+                self.add_counts(shard_tables)
         self.get_v_values()
         return
 
@@ -61,38 +124,57 @@ class adaptive_Heli():
 
     def get_dg_tn(self, n_grams: list, n: int, dialect:str) -> None:
         nstring = f'{n}_grams'
+        counts = self.counts[dialect][nstring]
+        adapted = self.adapted[dialect][nstring]
         dg = 0.0
         for n_gram in n_grams:
-            if n_gram in self.state[dialect][nstring]:
+            if n_gram in counts or n_gram in adapted:
                 dg += 1.0
         return dg
 
     def get_vg(self, word: str, n: int, dialect:str) -> None:
+        return self.get_word_scores(word, n)[dialect]
+
+    """
+    Returns the scores of a word for all dialects, memoized in a bounded LRU cache keyed by (word, n).
+    The cache is cleared whenever the scores change
+    """
+    def get_word_scores(self, word: str, n: int) -> dict:
+        scores = self.word_cache.get((word, n))
+        if scores is not None:
+            return scores
         nstring = f'{n}_grams'
         n_grams = util.get_n_grams(word, n)
-        dg_tn = self.get_dg_tn(n_grams, n, dialect)
-        if dg_tn == 0:
-            return self.config["penalty_p"]
-        sum = 0.0
-        for n_gram in n_grams:
-            if n_gram in self.state[dialect][nstring]:
-                sum += self.state[dialect][nstring][n_gram]
-        return sum / dg_tn
+        scores = {}
+        for dialect in self.counts.keys():
+            dg_tn = self.get_dg_tn(n_grams, n, dialect)
+            if dg_tn == 0:
+                scores[dialect] = self.config["penalty_p"]
+                continue
+            counts = self.counts[dialect][nstring]
+            adapted = self.adapted[dialect][nstring]
+            sum = 0.0
+            for n_gram in n_grams:
+                if n_gram in counts or n_gram in adapted:
+                    sum += self.get_score(n_gram, nstring, dialect)
+            scores[dialect] = sum / dg_tn
+        self.word_cache.put((word, n), scores)
+        return scores
+
+    def get_scores(self, row:dict, n:int) -> dict:
+        scores = dict.fromkeys(self.dataset.config['dialects'], 0.0)
+        for word in row['sentence_version'].split(" "):
+            word_scores = self.get_word_scores(word, n)
+            for dialect in scores.keys():
+                scores[dialect] += word_scores[dialect]
+        return scores
 
     def predict_dialect(self, row:dict, n:int) -> dict:
-        scores = {}
-        for dialect in self.dataset.config['dialects']:
-            scores[dialect] = 0.0
-            for word in row['sentence_version'].split(" "):
-                scores[dialect] += self.get_vg(word, n, dialect)
+        scores = self.get_scores(row, n)
         return (min(scores, key=scores.get))
 
     def get_cm(self, row:dict, n:int):
-        scores = {}
-        for dialect in self.dataset.config['dialects']:
-            scores[dialect] = 0.0
-            for word in row['sentence_version'].split(" "):
-                scores[dialect] += self.get_vg(word, n, dialect)
+        scores = self.get_scores(row, n)
         scores = {k: v for k, v in sorted(scores.items(), key=lambda item: item[1])}
         count = 0
         
@@ -109,54 +191,217 @@ class adaptive_Heli():
         confidence = r_h - r_g
         return confidence, prediction
 
+    """
+    Adds the n-grams of an adopted sentence to the counts of the dialect. Only the counts of these n-grams
+    and the number of n-grams change, the scores follow lazily (see get_score)
+    """
     def update_scores(self, row: pd.Series, dialect) -> None:
         for n in self.config['n']:
             nstring = f'{n}_grams'
+            counts = self.counts[dialect][nstring]
             for ngram in row[nstring]:
-                #print(ngram)
-                if self.counts[dialect][nstring].get(ngram) == None:
-                    self.counts[dialect][nstring][ngram] = 1
-                    self.state[dialect][nstring][ngram] = 0
-                else:
-                    self.counts[dialect][nstring][ngram] += 1
+                counts[ngram] = counts.get(ngram, 0) + 1
+            self.num_ngrams[dialect][nstring] = len(counts)
+        self.word_cache.clear()
+
+    """
+    Returns the step at which an adapted count set at step decays below online_min_count, inf if it never does
+    """
+    def get_expiry(self, count: float, step: int) -> float:
+        decay = self.config.get("online_decay", 1.0)
+        min_count = self.config.get("online_min_count", 0.5)
+        if decay >= 1.0 or min_count <= 0.0:
+            return inf
+        return step + floor(log(min_count / count) / log(decay)) + 1
+
+    """
+    Adds the n-grams of a sentence adopted in online mode to the adapted counts of the dialect. The trained counts
+    stay unchanged. Adapted counts decay by online_decay per adopted sentence and are removed once they fall below
+    online_min_count; if a dialect and order holds more than online_max_ngrams adapted n-grams, the least recently
+    adapted ones are evicted
+    """
+    def adapt_online(self, sentence: str, dialect: str) -> None:
+        decay = self.config.get("online_decay", 1.0)
+        max_ngrams = self.config.get("online_max_ngrams", 100000)
+        self.online_step += 1
+        self.remove_expired()
+        # expiry of a newly adapted n-gram, adapting it again only postpones it (see remove_expired)
+        expiry = self.get_expiry(1.0, self.online_step)
         for n in self.config['n']:
-                nstring = f'{n}_grams'
-                num_ngrams = len(self.state[dialect][nstring].keys())
-                for ngram in self.state[dialect][nstring].keys():
-                    count = self.counts[dialect][nstring][ngram]
-                    self.state[dialect][nstring][ngram] = -log10(count/num_ngrams)
-
-    def adaptive_prediction(self, df_test:pd.DataFrame, predictions:pd.Series, cutoff:int, n:int) -> pd.Series: 
-        while predictions.isnull().sum() > cutoff:
-            if predictions.isnull().sum() % 100 == 0:
-                print(predictions.isnull().sum() - cutoff, "NaN values remaining")
-           
-            confidence = df_test.apply(lambda x:  pd.Series(self.get_cm(x, self.config["n_eval"]), index=['confidence', 'prediction']), axis=1)
-            confidence = confidence.sort_values(by=["confidence"], ascending=False)
-            highest_conf = confidence.iloc[0]
-            predicted_dialect = highest_conf.loc["prediction"]
-            predictions[highest_conf.name] = predicted_dialect
-            self.update_scores(df_test.loc[highest_conf.name], predicted_dialect)
-
-            df_test = df_test.drop(highest_conf.name, axis=0)
+            nstring = f'{n}_grams'
+            counts = self.counts[dialect][nstring]
+            adapted = self.adapted[dialect][nstring]
+            for ngram in util.get_n_grams_sentence(sentence, n):
+                entry = adapted.get(ngram)
+                if entry is None:
+                    adapted[ngram] = [1.0, self.online_step]
+                    if ngram not in counts:
+                        self.num_adapted[dialect][nstring] += 1
+                    if expiry < inf:
+                        heapq.heappush(self.expiring, (expiry, dialect, nstring, ngram))
+                    continue
+                entry[0] = entry[0] * decay ** (self.online_step - entry[1]) + 1.0
+                entry[1] = self.online_step
+                adapted.move_to_end(ngram)
+            while len(adapted) > max_ngrams:
+                ngram, _ = adapted.popitem(last=False)
+                if ngram not in counts:
+                    self.num_adapted[dialect][nstring] -= 1
+        self.word_cache.clear()
 
-        return predictions
+    """
+    Removes the adapted counts that decayed below online_min_count. N-grams adapted again since they were scheduled
+    are scheduled again at their new expiry, items of evicted n-grams are skipped. The heap is rebuilt from the
+    adapted counts once it holds more than twice as many items
+    """
+    def remove_expired(self) -> None:
+        while self.expiring and self.expiring[0][0] <= self.online_step:
+            _, dialect, nstring, ngram = heapq.heappop(self.expiring)
+            entry = self.adapted[dialect][nstring].get(ngram)
+            if entry is None:
+                continue
+            expiry = self.get_expiry(entry[0], entry[1])
+            if expiry > self.online_step:
+                heapq.heappush(self.expiring, (expiry, dialect, nstring, ngram))
+                continue
+            del self.adapted[dialect][nstring][ngram]
+            if ngram not in self.counts[dialect][nstring]:
+                self.num_adapted[dialect][nstring] -= 1
+        num_adapted = sum(len(adapted) for orders in self.adapted.values() for adapted in orders.values())
+        if len(self.expiring) > 2 * num_adapted + 1024:
+            self.expiring = [(self.get_expiry(entry[0], entry[1]), dialect, nstring, ngram)
+                             for dialect, orders in self.adapted.items() for nstring, adapted in orders.items()
+                             for ngram, entry in adapted.items()]
+            self.expiring = [item for item in self.expiring if item[0] < inf]
+            heapq.heapify(self.expiring)
+
+    """
+    Online mode: classifies an unbounded iterable of sentences in micro-batches of batch_size and yields a
+    (prediction, confidence) tuple per sentence. Sentences are expected to be preprocessed like the
+    'sentence_version' column. After a micro-batch is classified, its sentences with a confidence of at least
+    online_threshold are adopted (see adapt_online), thus memory is bounded by online_max_ngrams per dialect and
+    order. The batch mode (predict) only adapts the trained counts, call reset_online() before using it
+    """
+    def predict_stream(self, sentences, batch_size: int=1):
+        n = self.config["n_eval"]
+        threshold = self.config.get("online_threshold", 0.0)
+        sentences = iter(sentences)
+        batch = list(islice(sentences, batch_size))
+        while batch:
+            results = [self.get_cm({'sentence_version': sentence}, n) for sentence in batch]
+            for sentence, (confidence, prediction) in zip(batch, results):
+                if confidence >= threshold:
+                    self.adapt_online(sentence, prediction)
+            for confidence, prediction in results:
+                yield prediction, confidence
+            batch = list(islice(sentences, batch_size))
+
+    """
+    Adopts the most confident prediction one at a time and updates the scores with it. The score of a sentence
+    for a dialect is kept split into the summed -log10(count) means of its words with known n-grams (A), the
+    number of those words (H) and the number of words without (U): score = A + H * log10(num_ngrams) + penalty * U.
+    After an adoption only the words containing one of the adopted n-grams (inverted index) and the sentences
+    containing those words are recomputed. The change of num_ngrams shifts every sentence, thus the
+    confidences are recomputed from the cached statistics with vectorized operations instead of a heap.
+    Every round adopts the config["adoption_batch"] most confident predictions before rescoring
+    """
+    def adaptive_prediction(self, df_test:pd.DataFrame, predictions:pd.Series, cutoff:int, n:int) -> pd.Series:
+        nstring = f'{n}_grams'
+        dialects = list(self.dataset.config['dialects'])
+        penalty = self.config["penalty_p"]
+
+        # sentence x word matrix and inverted index from n-grams to the words containing them
+        word_index = {}
+        sentence_ids, word_ids = [], []
+        for i, sentence in enumerate(df_test['sentence_version']):
+            for word in sentence.split(" "):
+                sentence_ids.append(i)
+                word_ids.append(word_index.setdefault(word, len(word_index)))
+        sentence_words = sparse.csr_matrix((np.ones(len(word_ids)), (sentence_ids, word_ids)), shape=(len(df_test.index), len(word_index)))
+        word_sentences = sentence_words.T.tocsr()
+        word_n_grams = [util.get_n_grams(word, n) for word in word_index.keys()]
+        inverted_index = {}
+        for i, n_grams in enumerate(word_n_grams):
+            for n_gram in set(n_grams):
+                inverted_index.setdefault(n_gram, []).append(i)
+
+        word_base = np.zeros((len(word_index), len(dialects)))
+        word_hits = np.zeros((len(word_index), len(dialects)))
+        for j, dialect in enumerate(dialects):
+            for i in range(len(word_n_grams)):
+                word_base[i, j], word_hits[i, j] = self.get_word_statistics(word_n_grams[i], n, dialect)
+        A = sentence_words @ (word_hits * word_base)
+        H = sentence_words @ word_hits
+        U = sentence_words @ (1.0 - word_hits)
+        log_num_ngrams = np.array([log10(self.num_ngrams[dialect][nstring]) for dialect in dialects])
 
+        active = np.ones(len(df_test.index), dtype=bool)
+        remaining = predictions.isnull().sum()
+        batch_size = self.get_adoption_batch_size(len(df_test.index))
+        while remaining > cutoff:
+            scores = A + H * log_num_ngrams + penalty * U
+            confidence = np.partition(scores, 1, axis=1)[:, 1] - scores.min(axis=1)
+            confidence[~active] = -np.inf
+            adopted = util.top_k(confidence, min(batch_size, remaining - cutoff))
 
+            affected_words = {}
+            for i in adopted:
+                j = int(np.argmin(scores[i]))
+                predicted_dialect = dialects[j]
+                predictions[df_test.index[i]] = predicted_dialect
+                self.update_scores(df_test.iloc[i], predicted_dialect)
+                active[i] = False
+                words = affected_words.setdefault(j, set())
+                for n_gram in df_test.iloc[i][nstring]:
+                    words.update(inverted_index.get(n_gram, ()))
+            if (remaining - cutoff) // 100 != (remaining - len(adopted) - cutoff) // 100:
+                print(remaining - len(adopted) - cutoff, "NaN values remaining")
+            remaining -= len(adopted)
 
+            # only the statistics of the adopted dialects change
+            for j, words in affected_words.items():
+                log_num_ngrams[j] = log10(self.num_ngrams[dialects[j]][nstring])
+                if not words:
+                    continue
+                words = list(words)
+                for w in words:
+                    word_base[w, j], word_hits[w, j] = self.get_word_statistics(word_n_grams[w], n, dialects[j])
+                affected_sentences = np.unique(word_sentences[words].indices)
+                affected_sentence_words = sentence_words[affected_sentences]
+                A[affected_sentences, j] = affected_sentence_words @ (word_hits[:, j] * word_base[:, j])
+                H[affected_sentences, j] = affected_sentence_words @ word_hits[:, j]
+                U[affected_sentences, j] = affected_sentence_words @ (1.0 - word_hits[:, j])
+
+        return predictions
 
     """
-    Main testing function of this model
+    Number of sentences adopted per round: config["adoption_batch"] is either a count (int) or a fraction
+    of the test set (float below 1)
     """
-    def test(self) -> None:
-        print(f"Running the configuration with \n n_eval={self.config['n_eval']}, \n cutoff={self.config['cutoff']}, \n penalty={self.config['penalty_p']}")
+    def get_adoption_batch_size(self, n_sentences: int) -> int:
+        adoption_batch = self.config.get("adoption_batch", 1)
+        if isinstance(adoption_batch, float) and adoption_batch < 1:
+            return max(1, int(adoption_batch * n_sentences))
+        return max(1, int(adoption_batch))
 
-        X_test, Y_test = self.dataset.get_test_data()
-        X_test.insert(0, 'dialect', Y_test.squeeze())
-        df_test = X_test
-        
+    """
+    Returns the mean of -log10(count) over the known n-grams of a word and 1, or (0, 0) if no n-gram is known.
+    The score of the word is this mean plus log10(num_ngrams) of the dialect
+    """
+    def get_word_statistics(self, n_grams: list, n: int, dialect: str) -> Tuple[float, float]:
+        counts = self.counts[dialect][f'{n}_grams']
+        known = [counts[n_gram] for n_gram in n_grams if n_gram in counts]
+        if not known:
+            return 0.0, 0.0
+        return sum(-log10(count) for count in known) / len(known), 1.0
+
+    """
+    Predicts the dialect of every row in X_test, adapting the model to the adopted predictions
+    """
+    def predict(self, X_test: pd.DataFrame) -> pd.Series:
         n = self.config["n_eval"]
-        X_test = X_test[["sentence_version", f"{n}_grams"]]
+        # update_scores needs the n-grams of all orders
+        X_test = X_test[["sentence_version"] + [f"{n_s}_grams" for n_s in self.config["n"]]]
         predictions = pd.Series(NaN, X_test.index)
         cutoff = int(self.config["cutoff"] * len(predictions.index))
         if cutoff > len(predictions.index) or cutoff < 0: 
@@ -167,7 +412,18 @@ class adaptive_Heli():
             X_test = X_test.drop(X_test[predictions.notna()].index)
             basic_predictions = X_test.apply(lambda x: self.predict_dialect(x, n), axis=1)
             predictions = predictions.combine_first(basic_predictions)
+        return predictions
+
+    """
+    Main testing function of this model
+    """
+    def test(self) -> None:
+        print(f"Running the configuration with \n n_eval={self.config['n_eval']}, \n cutoff={self.config['cutoff']}, \n penalty={self.config['penalty_p']}")
+
+        X_test, Y_test = self.dataset.get_test_data()
+        predictions = self.predict(X_test)
+        print(f"Word score cache: {self.word_cache.hits} hits, {self.word_cache.misses} misses")
         print(f"Results for the configuration with \n n_eval={self.config['n_eval']}, \n cutoff={self.config['cutoff']}, \n penalty={self.config['penalty_p']}")
-        util.evaluate(df_test, predictions, self.dataset.config["dialects"])
+        util.evaluate(Y_test, predictions, self.dataset.config["dialects"])
 
     
\ No newline at end of file
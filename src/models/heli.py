@@ -2,7 +2,11 @@
 Implementation of the Heli model
 """
 
+from itertools import islice
 from math import log10
+import numpy as np
+import pandas as pd
+from scipy import sparse
 
 import src.utils.utils as util
 
@@ -16,36 +20,196 @@ class Heli():
             self.state[dialect] = {}
             for n in self.config['n']:
                 self.state[dialect][f'{n}_grams'] = {}
+        self.counts = {}
+        for dialect in self.dataset.config['dialects']:
+            self.counts[dialect] = {}
+            for n in self.config['n']:
+                self.counts[dialect][f'{n}_grams'] = {}
+        self.compiled = {}
+        self.array_tables = False # if set, scores are only available in self.compiled
+        self.word_cache = util.LRUCache(self.config.get("cache_size", 0))
+        self.hash_bits = self.config.get("hash_bits", 0)
+        if self.hash_bits:
+            # fixed memory: counts and scores per dialect, order and hash bucket instead of dicts
+            self.vocabulary = util.HashedNGramVocabulary(self.hash_bits)
+            shape = (len(self.state), len(self.config['n']), len(self.vocabulary))
+            self.hash_counts = np.zeros(shape, dtype=np.int32)
+            self.hash_scores = np.zeros(shape, dtype=np.float32)
 
     def count_ngrams(self, row: dict) -> None:
         dialect = row['dialect']
-        if not dialect in self.state.keys():
+        if not dialect in self.counts.keys():
             return
         for n in self.config['n']:
             nstring = f'{n}_grams'
             for ngram in row[nstring]:
-                if self.state[dialect][nstring].get(ngram) == None:
-                    self.state[dialect][nstring][ngram] = 1
+                if self.counts[dialect][nstring].get(ngram) == None:
+                    self.counts[dialect][nstring][ngram] = 1
                 else:
-                    self.state[dialect][nstring][ngram] += 1
+                    self.counts[dialect][nstring][ngram] += 1
 
     def get_v_values(self) -> None:
+        if self.hash_bits:
+            self.get_hashed_v_values()
+            return
         for dialect in self.dataset.config['dialects']:
             for n in self.config['n']:
                 nstring = f'{n}_grams'
-                num_ngrams = len(self.state[dialect][nstring].keys())
-                for ngram, count in self.state[dialect][nstring].items():
+                num_ngrams = len(self.counts[dialect][nstring].keys())
+                self.state[dialect][nstring] = {}
+                for ngram, count in self.counts[dialect][nstring].items():
                     self.state[dialect][nstring][ngram] = -log10(count/num_ngrams)
+        self.word_cache.clear()
+        if self.config.get("compiled", False):
+            self.compile_scores()
+
+    """
+    Computes the scores of the hashed counts in place in self.hash_scores, per dialect and order in blocks of
+    block_size buckets, thus the temporary memory does not grow with hash_bits
+    """
+    def get_hashed_v_values(self, block_size: int=1 << 16) -> None:
+        for d in range(self.hash_counts.shape[0]):
+            for i in range(self.hash_counts.shape[1]):
+                counts, scores = self.hash_counts[d, i], self.hash_scores[d, i]
+                num_ngrams = max(np.count_nonzero(counts), 1)
+                for start in range(0, len(counts), block_size):
+                    block = counts[start:start + block_size]
+                    values = np.zeros(len(block))
+                    np.log10(block / num_ngrams, out=values, where=block > 0)
+                    np.negative(values, out=scores[start:start + block_size], casting='same_kind')
+        self.word_cache.clear()
+        self.compile_scores()
+        self.array_tables = True
+
+    """
+    Builds a global n-gram vocabulary shared by all orders and dense (n_dialects x vocab) matrices
+    holding the -log10 values and a hit-mask (1 if the dialect has seen the n-gram, 0 otherwise) of the
+    same dtype. Hashed models use their counts as hit-mask (nonzero if seen) instead of a copy, the
+    hit-masks are only compared to 0 on the columns that are used.
+    self.compiled maps every n to (vocabulary, values, hits)
+    """
+    def compile_scores(self) -> None:
+        self.compiled_dialects = list(self.state.keys())
+        if self.hash_bits:
+            self.compiled = {n: (self.vocabulary, self.hash_scores[:, i], self.hash_counts[:, i]) for i, n in enumerate(self.config['n'])}
+            return
+        vocabulary = util.NGramVocabulary()
+        for dialect in self.compiled_dialects:
+            for n in self.config['n']:
+                for ngram in self.state[dialect][f'{n}_grams']:
+                    vocabulary.add(ngram)
+        values = np.zeros((len(self.compiled_dialects), len(vocabulary)))
+        hits = np.zeros((len(self.compiled_dialects), len(vocabulary)))
+        for i, dialect in enumerate(self.compiled_dialects):
+            for n in self.config['n']:
+                table = self.state[dialect][f'{n}_grams']
+                columns = [vocabulary.ids[ngram] for ngram in table]
+                values[i, columns] = list(table.values())
+                hits[i, columns] = 1.0
+        self.compiled = {n: (vocabulary, values, hits) for n in self.config['n']}
+
+    """
+    Returns the scores as arrays per order, used to store the model: {n: (n_grams, scores, hits)} with the
+    sorted n-gram vocabulary (None if hashed), float32 (n_dialects x vocab) scores and a float32 hit-mask
+    """
+    def export_tables(self) -> dict:
+        if self.array_tables:
+            tables = {}
+            for n, (vocabulary, values, hits) in self.compiled.items():
+                n_grams = None if self.hash_bits else np.asarray(vocabulary.n_grams)
+                tables[n] = (n_grams, np.asarray(values, dtype=np.float32), (np.asarray(hits) > 0).astype(np.float32))
+            return {"dialects": self.compiled_dialects, "tables": tables}
+        tables = {}
+        for n in self.config['n']:
+            nstring = f'{n}_grams'
+            n_grams = set()
+            for dialect in self.state.keys():
+                n_grams.update(self.state[dialect][nstring].keys())
+            n_grams = np.sort(np.array(list(n_grams), dtype=str))
+            values = np.zeros((len(self.state), len(n_grams)), dtype=np.float32)
+            hits = np.zeros((len(self.state), len(n_grams)), dtype=np.float32)
+            for i, dialect in enumerate(self.state.keys()):
+                table = self.state[dialect][nstring]
+                if len(table) == 0:
+                    continue
+                columns = np.searchsorted(n_grams, np.array(list(table.keys()), dtype=str))
+                values[i, columns] = list(table.values())
+                hits[i, columns] = 1.0
+            tables[n] = (n_grams, values, hits)
+        return {"dialects": list(self.state.keys()), "tables": tables}
+
+    """
+    Sets the scores from arrays as returned by export_tables, e.g. memory-mapped from a stored model.
+    The model can predict afterwards but not be trained further
+    """
+    def load_tables(self, dialects: list, tables: dict) -> None:
+        self.compiled_dialects = dialects
+        self.compiled = {}
+        for n, (n_grams, values, hits) in tables.items():
+            vocabulary = util.HashedNGramVocabulary(self.hash_bits) if n_grams is None else util.SortedNGramVocabulary(n_grams)
+            self.compiled[n] = (vocabulary, values, hits)
+        self.array_tables = True
+        self.word_cache.clear()
+
+    """
+    Adds the n-gram counts of a batch of sentences given as CSR-style id arrays
+    (see util.extract_n_gram_ids) to the count tables
+    """
+    def count_n_gram_ids(self, dialects: list, n_gram_ids: dict, vocabulary: object) -> None:
+        self.add_counts(util.count_n_gram_ids(dialects, n_gram_ids, vocabulary, list(self.counts.keys())))
+
+    """
+    Merges count tables as returned by util.count_n_grams into the count tables of the model
+    """
+    def add_counts(self, tables: dict) -> None:
+        for i, (dialect, orders) in enumerate(tables.items()):
+            for n, (keys, counts) in orders.items():
+                if self.hash_bits:
+                    self.hash_counts[i, self.config['n'].index(n), keys] += counts.astype(np.int32)
+                    continue
+                table = self.counts[dialect][f'{n}_grams']
+                for ngram, count in zip(keys.tolist(), counts.tolist()):
+                    table[ngram] = table.get(ngram, 0) + count
+
+    """
+    Adds the n-gram counts of an iterable of (dialect, sentence) pairs to the count tables.
+    Sentences are expected to be preprocessed like the 'sentence_version' column. Only batch_size
+    sentences are held in memory at once. Can be called repeatedly, call finalize() to compute the scores
+    """
+    def partial_fit(self, rows, batch_size: int=10000) -> None:
+        rows = iter(rows)
+        batch = list(islice(rows, batch_size))
+        while batch:
+            dialects, sentences = zip(*batch)
+            self.add_counts(util.count_n_grams(dialects, sentences, self.config['n'], list(self.counts.keys()), self.hash_bits))
+            batch = list(islice(rows, batch_size))
+
+    """
+    Counts the n-grams of the sentences in a pool of worker processes and merges the
+    count tables of all shards in order. Gives the same counts as partial_fit
+    """
+    def parallel_fit(self, dialects: list, sentences: list, n_workers: int) -> None:
+        tables = util.count_n_grams_parallel(dialects, sentences, self.config['n'], list(self.counts.keys()), self.hash_bits, n_workers)
+        for shard_tables in tables:
+            self.add_counts(shard_tables)
+
+    """
+    Computes the scores from the counts added so far
+    """
+    def finalize(self) -> None:
+        self.get_v_values()
 
     """
     Main training function of this model
     """
     def train(self) -> None:
         X_train, Y_train = self.dataset.get_train_data()
-        X_train.insert(0, 'dialect', Y_train.squeeze())
-        df = X_train
-        df.apply(lambda x: self.count_ngrams(x), axis=1)
-        self.get_v_values()
+        n_workers = self.config.get("n_workers", 1)
+        if n_workers == 1:
+            self.partial_fit(zip(Y_train['dialect'], X_train['sentence_version']))
+        else:
+            self.parallel_fit(Y_train['dialect'].tolist(), X_train['sentence_version'].tolist(), n_workers)
+        self.finalize()
         return
 
         
@@ -59,33 +223,135 @@ class Heli():
         return dg
 
     def get_vg(self, word: str, n: int, dialect:str) -> None:
+        return self.get_word_scores(word, n)[dialect]
+
+    """
+    Returns the scores of a word for all dialects. The n-grams of the word are only created once
+    and the scores are memoized in a bounded LRU cache keyed by (word, n)
+    """
+    def get_word_scores(self, word: str, n: int) -> dict:
+        scores = self.word_cache.get((word, n))
+        if scores is not None:
+            return scores
         nstring = f'{n}_grams'
         n_grams = util.get_n_grams(word, n)
-        dg_tn = self.get_dg_tn(n_grams, n, dialect)
-        if dg_tn == 0:
-            return self.config["penalty_p"]
-        sum = 0.0
-        for n_gram in n_grams:
-            if n_gram in self.state[dialect][nstring]:
-                sum += self.state[dialect][nstring][n_gram]
-        return sum / dg_tn
+        scores = {}
+        if self.array_tables:
+            vocabulary, values, hits = self.compiled[n]
+            columns = vocabulary.get_ids(n_grams)
+            columns = columns[columns >= 0]
+            word_hits = hits[:, columns] > 0
+            dg_tn = word_hits.sum(axis=1, dtype=values.dtype)
+            sums = np.where(word_hits, values[:, columns], 0.0).sum(axis=1)
+            for i, dialect in enumerate(self.compiled_dialects):
+                scores[dialect] = sums[i] / dg_tn[i] if dg_tn[i] > 0 else self.config["penalty_p"]
+            self.word_cache.put((word, n), scores)
+            return scores
+        for dialect in self.state.keys():
+            dg_tn = self.get_dg_tn(n_grams, n, dialect)
+            if dg_tn == 0:
+                scores[dialect] = self.config["penalty_p"]
+                continue
+            sum = 0.0
+            for n_gram in n_grams:
+                if n_gram in self.state[dialect][nstring]:
+                    sum += self.state[dialect][nstring][n_gram]
+            scores[dialect] = sum / dg_tn
+        self.word_cache.put((word, n), scores)
+        return scores
 
     def predict_dialect(self, row:dict, n:int) -> dict:
-        scores = {}
-        for dialect in self.dataset.config['dialects']:
-            scores[dialect] = 0.0
-            for word in row['sentence_version'].split(" "):
-                scores[dialect] += self.get_vg(word, n, dialect)
+        scores = dict.fromkeys(self.dataset.config['dialects'], 0.0)
+        for word in row['sentence_version'].split(" "):
+            word_scores = self.get_word_scores(word, n)
+            for dialect in scores.keys():
+                scores[dialect] += word_scores[dialect]
         return (min(scores, key=scores.get))
 
+    """
+    Scores all sentences at once with the compiled matrices. Returns a (n_sentences x n_dialects)
+    matrix with the same values predict_dialect sums up per dialect
+    """
+    def score_sentences(self, sentences: list, n: int) -> np.ndarray:
+        matched, unmatched = self.get_sentence_statistics(sentences, n)
+        return matched + float(self.config["penalty_p"]) * unmatched
+
+    """
+    Returns the sufficient statistics of the scores of all sentences as two (n_sentences x n_dialects) matrices:
+    the summed scores of the words with at least one known n-gram and the number of words without one.
+    The score for a penalty p is matched + p * unmatched
+    """
+    def get_sentence_statistics(self, sentences: list, n: int) -> tuple:
+        vocabulary, values, hits = self.compiled[n]
+        # the tables may be memory-mapped and shared by several processes: only the columns of the n-grams
+        # in the sentences are read, the dialects are put into the order of the dataset on the results
+        rows = [self.compiled_dialects.index(dialect) for dialect in self.dataset.config['dialects']]
+
+        # sentence x word matrix over the unique words of all sentences
+        word_index = {}
+        sentence_ids, word_ids = [], []
+        for i, sentence in enumerate(sentences):
+            for word in sentence.split(" "):
+                sentence_ids.append(i)
+                word_ids.append(word_index.setdefault(word, len(word_index)))
+        sentence_words = sparse.csr_matrix((np.ones(len(word_ids)), (sentence_ids, word_ids)), shape=(len(sentences), len(word_index)))
+
+        # word x n-gram matrix, n-grams not seen in training do not contribute to any score
+        word_vocabulary = util.NGramVocabulary()
+        offsets, ids = util.extract_n_gram_ids(word_index.keys(), [n], word_vocabulary)[n]
+        offsets, ids = util.remap_n_gram_ids(offsets, ids, vocabulary.get_ids(word_vocabulary.get_n_grams()))
+        word_ngrams = util.n_gram_id_matrix(offsets, ids, len(vocabulary))
+        columns = np.unique(word_ngrams.indices)
+        word_ngrams = word_ngrams[:, columns]
+
+        sums = (word_ngrams @ values[:, columns].T)[:, rows]
+        dg_tn = (word_ngrams @ (hits[:, columns] > 0).astype(values.dtype).T)[:, rows]
+        vg = np.zeros(sums.shape)
+        np.divide(sums, dg_tn, out=vg, where=dg_tn > 0)
+        return sentence_words @ vg, sentence_words @ (dg_tn == 0).astype(float)
+
+    def predict_compiled(self, df, n: int) -> pd.Series:
+        scores = self.score_sentences(df['sentence_version'].tolist(), n)
+        dialects = np.asarray(self.dataset.config['dialects'], dtype=object)
+        return pd.Series(dialects[np.argmin(scores, axis=1)], index=df.index)
+
+    """
+    Evaluates all combinations of n_eval and penalty_p on df. The sentence statistics are computed once per n,
+    every penalty is then only a re-aggregation. Returns a table with the metrics of util.get_metrics
+    """
+    def sweep(self, df, labels, n_evals: list, penalties: list) -> pd.DataFrame:
+        if not self.compiled:
+            self.compile_scores()
+        dialects = np.asarray(self.dataset.config['dialects'], dtype=object)
+        results = []
+        for n in n_evals:
+            matched, unmatched = self.get_sentence_statistics(df['sentence_version'].tolist(), n)
+            for penalty in penalties:
+                predictions = pd.Series(dialects[np.argmin(matched + penalty * unmatched, axis=1)], index=df.index)
+                results.append({"n_eval": n, "penalty_p": penalty, **util.get_metrics(labels, predictions, list(dialects))})
+        return pd.DataFrame(results)
+
+    """
+    Predicts the dialect of every row in df, in parallel chunks if n_workers is not 1
+    """
+    def predict(self, df) -> pd.Series:
+        n_workers = self.config.get("n_workers", 1)
+        if n_workers != 1:
+            return util.predict_parallel(self, df, n_workers)
+        predictions = self.predict_rows(df)
+        if not (self.config.get("compiled", False) or self.array_tables):
+            print(f"Word score cache: {self.word_cache.hits} hits, {self.word_cache.misses} misses")
+        return predictions
+
+    def predict_rows(self, df) -> pd.Series:
+        if self.config.get("compiled", False) or self.array_tables:
+            return self.predict_compiled(df, self.config["n_eval"])
+        return df.apply(lambda x: self.predict_dialect(x, self.config["n_eval"]), axis=1)
+
     """
     Main testing function of this model
     """
     def test(self) -> None:
         X_test, Y_test = self.dataset.get_test_data()
-        X_test.insert(0, 'dialect', Y_test.squeeze())
-        df = X_test
-        predictions = df.apply(lambda x: self.predict_dialect(x, self.config["n_eval"]), axis=1)
-        util.evaluate(df, predictions, self.dataset.config["dialects"])
-
-    
\ No newline at end of file
+        predictions = self.predict(X_test)
+        util.evaluate(Y_test, predictions, self.dataset.config["dialects"])
@@ -1,11 +1,12 @@
 """
 This file loads the model that is specified in the configuration
 """
+import json
 import pickle
 import shutil
 import os
 from datetime import datetime as dt
-from numpy import object0
+import numpy as np
 from src.models.adaptive_heli import adaptive_Heli
 from src.models.heli import Heli
 from src.models.svm import SVM
@@ -25,6 +26,10 @@ def get_model(config: Config, dataset: object) -> object:
 
 def load_model(path: str, dataset: object) -> object:
     try:
+        if os.path.exists('models/' + path + '/metadata.json'):
+            loaded_model = load_tables('models/' + path, dataset)
+            print("Model stored under {} loaded.".format('models/' + path))
+            return loaded_model
         with open('models/' + path + '/model.pickle', 'rb') as f:
             loaded_model = pickle.load(f)
             loaded_model.dataset = dataset
@@ -37,19 +42,70 @@ def load_model(path: str, dataset: object) -> object:
 def store_model(model, name: str) -> None:
     try:
         model_path = model.name + "-" + dt.now().strftime("%Y-%m-%d_%H-%M-%S") if name == "" else name
-        # create dir
+        # create a fresh dir, it replaces a model stored under the same name only once it is complete,
+        # thus no files of the previous model are left behind
         dir_path = 'models/' + model_path
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-        # store model
-        with open(dir_path + '/model.pickle', 'wb') as f:
-            pickle.dump(model, f)
-            print("Model stored under {}.".format(dir_path))
+        tmp_path = dir_path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        # store model, models with score tables use the binary format
+        if hasattr(model, "export_tables"):
+            store_tables(model, tmp_path)
+        else:
+            with open(tmp_path + '/model.pickle', 'wb') as f:
+                pickle.dump(model, f)
         # store config
         origin = "config.py"
-        destination = dir_path + "/config.py"
+        destination = tmp_path + "/config.py"
         shutil.copyfile(origin, destination)
-        
+        if os.path.exists(dir_path):
+            shutil.rmtree(dir_path)
+        os.rename(tmp_path, dir_path)
+        print("Model stored under {}.".format(dir_path))
+
     except:
         print("Model could not be stored")
-        return
\ No newline at end of file
+        return
+
+"""
+Binary model format: metadata.json with the model config and dialects and per n-gram order
+'{n}_grams.npy' (sorted vocabulary, missing if config['hash_bits'] is set), '{n}_grams_scores.npy' (float32,
+n_dialects x vocab) and '{n}_grams_hits.npy' (float32 0/1, n_dialects x vocab)
+"""
+def store_tables(model, dir_path: str) -> None:
+    exported = model.export_tables()
+    for n, (n_grams, values, hits) in exported["tables"].items():
+        if n_grams is not None:
+            np.save(dir_path + f'/{n}_grams.npy', n_grams)
+        np.save(dir_path + f'/{n}_grams_scores.npy', values)
+        np.save(dir_path + f'/{n}_grams_hits.npy', hits)
+    metadata = {
+        "model": model.name,
+        "config": model.config,
+        "dialects": exported["dialects"],
+        "n": list(exported["tables"].keys())
+    }
+    with open(dir_path + '/metadata.json', 'w') as f:
+        json.dump(metadata, f, indent=4)
+
+"""
+Loads a model stored with store_tables. The arrays are memory-mapped, thus pages are only read when
+used and shared between processes
+"""
+def load_tables(dir_path: str, dataset: object) -> object:
+    with open(dir_path + '/metadata.json', 'r') as f:
+        metadata = json.load(f)
+    if metadata["model"] != "Heli":
+        print("Invalid stored model type. Aborting")
+        raise NotImplementedError
+    model = Heli(config=metadata["config"], dataset=dataset)
+    hashed = metadata["config"].get("hash_bits", 0) > 0
+    tables = {}
+    for n in metadata["n"]:
+        n_grams = None if hashed else np.load(dir_path + f'/{n}_grams.npy', mmap_mode='r')
+        values = np.load(dir_path + f'/{n}_grams_scores.npy', mmap_mode='r')
+        hits = np.load(dir_path + f'/{n}_grams_hits.npy', mmap_mode='r')
+        tables[n] = (n_grams, values, hits)
+    model.load_tables(metadata["dialects"], tables)
+    return model
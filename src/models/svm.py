@@ -1,15 +1,62 @@
 """
 Implementation of the SVM model
 """
+import ctypes
+import ctypes.util
+from multiprocessing import get_context
+import os
 import numpy as np
+import pandas as pd
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.preprocessing import MultiLabelBinarizer
-import scipy
+from scipy import sparse
+from scipy.special import expit
 from libsvm.svmutil import *
 
 
 import src.utils.utils as util
 
+# feature matrix and labels shared with the forked workers of train_models
+_shared_training = None
+
+"""
+Seeds the C rand() libsvm draws the cross-validation folds of the probability estimates from, thus a model
+does not depend on the models trained before it in the same process
+"""
+def _seed_libsvm(seed: int) -> None:
+    libc = ctypes.util.find_library('c')
+    if libc:
+        ctypes.CDLL(libc).srand(seed)
+
+def _train_dialect(i: int, model_name: str, parameters: str) -> None:
+    X_encoded, Y_encoded = _shared_training
+    _seed_libsvm(1)
+    prob  = svm_problem(Y_encoded[:,i], X_encoded)
+    param = svm_parameter(parameters)
+    m = svm_train(prob, param)
+    # an interrupted job must not leave a partial model file behind
+    svm_save_model(model_name + '.tmp', m)
+    os.replace(model_name + '.tmp', model_name)
+
+"""
+Trains and saves the model of every (dialect index, model file) job in a pool of n_workers forked processes
+(all cores if n_workers < 1), or in the main process if n_workers is 1. The workers share the feature matrix
+copy-on-write. Every job is seeded the same way, so the model files do not depend on the number of workers
+"""
+def train_models(X_encoded: sparse.csr_matrix, Y_encoded: np.ndarray, jobs: list, parameters: str, n_workers: int=1) -> None:
+    global _shared_training
+    n_workers = n_workers if n_workers > 0 else os.cpu_count()
+    _shared_training = (X_encoded, Y_encoded)
+    try:
+        if n_workers == 1 or len(jobs) < 2:
+            for i, model_name in jobs:
+                _train_dialect(i, model_name, parameters)
+        else:
+            with get_context("fork").Pool(min(n_workers, len(jobs))) as pool:
+                pool.starmap(_train_dialect, [(i, model_name, parameters) for i, model_name in jobs])
+    finally:
+        _shared_training = None
+
 class SVM():
     def __init__(self, config: dict, dataset: object) -> None:
         self.config = config
@@ -20,19 +67,47 @@ class SVM():
 
         self.models = []
         self.n = config['n_dialects']
+        self.parameters = '-t 0 -c 1 -b 1 -h 0'
+        self.model_cache = util.ArtifactCache('models/', config.get("model_cache_size", 0))
+        # linear fast path: (n_features x n_dialects) weights, decision = X @ weights - rho, see compile_weights
+        self.weights = None
+
+        self.hash_bits = config.get("hash_bits", 0)
+        if self.hash_bits:
+            # fixed feature space of 2^hash_bits buckets per n-gram order instead of fitted encoders
+            self.vocabulary = util.HashedNGramVocabulary(self.hash_bits)
   
 
+    """
+    Builds the vocabulary of every n-gram order from the training data only, keeping the n-grams of at least
+    min_count training sentences and at most max_features of them per order, and reports the savings
+    """
     def init_feature_encoders(self):
+        if self.hash_bits:
+            return
         X_train, _ = self.dataset.get_train_data()
-        X_test, _ = self.dataset.get_test_data()
 
-        for n in self.config['n']:
-            n_grams_per_sentence = X_train[f'{n}_grams'].tolist() + X_test[f'{n}_grams'].tolist()
+        print("{:<6} {:>10} {:>10} {:>12} {:>12}".format("n", "n-grams", "features", "nnz", "nnz kept"))
+        total, kept, total_nnz, kept_nnz = 0, 0, 0, 0
+        for i, n in enumerate(self.config['n']):
+            frequencies = util.count_document_frequencies(X_train[f'{n}_grams'].tolist())
+            vocabulary = util.prune_vocabulary(frequencies, self.get_order_setting("min_count", 1, i), self.get_order_setting("max_features", 0, i))
+            self.feature_encoders.append(vocabulary)
 
-            encoder = MultiLabelBinarizer()
-            encoder.fit(n_grams_per_sentence)
+            nnz = sum(frequencies.values())
+            nnz_kept = sum(frequencies[n_gram] for n_gram in vocabulary.ids)
+            print("{:<6} {:>10} {:>10} {:>12} {:>12}".format(n, len(frequencies), len(vocabulary), nnz, nnz_kept))
+            total, kept, total_nnz, kept_nnz = total + len(frequencies), kept + len(vocabulary), total_nnz + nnz, kept_nnz + nnz_kept
 
-            self.feature_encoders.append(encoder)
+        # a CSR entry takes a float64 value and an int32 column index, a weight a float64 per dialect
+        print("{:<6} {:>10} {:>10} {:>12} {:>12}".format("total", total, kept, total_nnz, kept_nnz))
+        print(f"Feature matrix: {total_nnz * 12 / 2**20:.1f} MB -> {kept_nnz * 12 / 2**20:.1f} MB, "
+              f"weights: {total * self.n * 8 / 2**20:.1f} MB -> {kept * self.n * 8 / 2**20:.1f} MB")
+
+    # min_count and max_features are an int for all n-gram orders or a list with a value per order in config['n']
+    def get_order_setting(self, key: str, default: int, i: int) -> int:
+        value = self.config.get(key, default)
+        return value[i] if isinstance(value, list) else value
 
     def init_target_encoder(self):
         _, Y_train = self.dataset.get_train_data()
@@ -41,18 +116,34 @@ class SVM():
         self.target_encoder.fit_transform(np.array(Y_train['dialect'].tolist() + Y_test['dialect'].tolist()).reshape(-1, 1))
 
     def encode_features(self, X, predict):
-        # use the multilabelbinarizer for all n we have n-grams for and concatenate to single feature matrix
+        if self.hash_bits:
+            return self.encode_hashed_features(X, predict)
+        # binary sparse features like the multilabelbinarizer, one block of columns per n, n-grams missing
+        # from the vocabulary are dropped
         X_encoded_split = []
-        for n in self.config['n']:
-            if predict:
-                X_encoded_part = self.feature_encoders[n-1].transform([X[f'{n}_grams']])
-            else:
-                X_encoded_part = self.feature_encoders[n-1].transform(X[f'{n}_grams'].tolist())
+        for n, vocabulary in zip(self.config['n'], self.feature_encoders):
+            n_grams_per_sentence = [X[f'{n}_grams']] if predict else X[f'{n}_grams'].tolist()
+            ids = [vocabulary.get_ids(n_grams) for n_grams in n_grams_per_sentence]
+            ids = [x[x >= 0] for x in ids]
+            offsets = np.cumsum([0] + [len(x) for x in ids])
+            X_encoded_part = util.n_gram_id_matrix(offsets, np.concatenate(ids), len(vocabulary))
+            X_encoded_part.data[:] = 1.0
             X_encoded_split.append(X_encoded_part)
 
-        X_encoded = np.concatenate(X_encoded_split, axis=1)
+        return sparse.hstack(X_encoded_split, format='csr', dtype=np.float64)
 
-        return X_encoded
+    def encode_hashed_features(self, X, predict):
+        # binary sparse features like the multilabelbinarizer, one block of buckets per n
+        X_encoded_split = []
+        for n in self.config['n']:
+            n_grams_per_sentence = [X[f'{n}_grams']] if predict else X[f'{n}_grams'].tolist()
+            ids = [self.vocabulary.get_buckets(n_grams) for n_grams in n_grams_per_sentence]
+            offsets = np.cumsum([0] + [len(x) for x in ids])
+            X_encoded_part = util.n_gram_id_matrix(offsets, np.concatenate(ids), len(self.vocabulary))
+            X_encoded_part.data[:] = 1.0
+            X_encoded_split.append(X_encoded_part)
+
+        return sparse.hstack(X_encoded_split, format='csr', dtype=np.float64)
 
 
     """
@@ -68,8 +159,8 @@ class SVM():
 
         Y_encoded = self.target_encoder.transform(np.array(Y_train['dialect'].tolist()).reshape(-1, 1))
 
-        X_encoded_wrapped = scipy.asarray(X_encoded)
-        Y_encoded_wrapped = scipy.asarray(Y_encoded)
+        # libsvm builds its problem directly from the CSR arrays
+        Y_encoded_wrapped = np.asarray(Y_encoded)
 
         """
         Parameters
@@ -98,63 +189,166 @@ class SVM():
         -q output: suppress output to terminal
         """
 
-        # train a  model per dialect
-        for i in range(0,self.n):
-            model_name = 'models/d' + str(i) + '_vardial17_linear_c1.model'
-            # try and load model from storage
+        # trained models are cached in models/<key>/ where the key hashes everything they depend on
+        description = self.get_cache_description(X_train, Y_train)
+        key = self.model_cache.get_key(description)
+        path = self.model_cache.get_path(key)
+        weights_name = os.path.join(path, 'weights.npz')
+        if self.model_cache.contains(key):
+            self.model_cache.touch(key)
+            # the compact weights replace the per dialect models if they match the feature space
+            if self.load_weights(weights_name, X_encoded.shape[1]):
+                print('loaded weights from', path)
+                return
+
+        # train the missing model per dialect in parallel, then load all of them from storage
+        model_names = [os.path.join(path, f'd{i}.model') for i in range(0,self.n)]
+        jobs = [(i, model_name) for i, model_name in enumerate(model_names) if not os.path.exists(model_name)]
+        if jobs:
+            print('training models', [i for i, _ in jobs])
+            train_models(X_encoded, Y_encoded_wrapped, jobs, self.parameters, self.config.get("n_workers", 1))
+
+        for i, model_name in enumerate(model_names):
             m = svm_load_model(model_name)
-
-            # train model if none could be loaded
-            if m is None:
-                print('training model', i)
-                prob  = svm_problem(Y_encoded_wrapped[:,i], X_encoded_wrapped)
-                param = svm_parameter('-t 0 -c 1 -b 1 -h 0')  
-                m = svm_train(prob, param)
-                svm_save_model(model_name, m)
-            else:
-                print('loaded model', i)
-            
+            print('loaded model', i)
             self.models.append(m)
 
+        self.compile_weights(X_encoded.shape[1])
+        if self.weights is not None:
+            self.store_weights(weights_name)
+        self.model_cache.store(key, description)
 
+    """
+    Returns everything the trained models depend on: the dataset, the preprocessing steps, the n-gram orders,
+    the feature space, the libsvm parameters and a hash of the data the models are trained on
+    """
+    def get_cache_description(self, X_train, Y_train) -> dict:
+        preprocessing = getattr(self.dataset, 'preprocessing', None)
+        return {
+            "dataset": {key: self.dataset.config.get(key) for key in ["name", "raw_data_path", "split", "dialects", "datasets"]},
+            "preprocessing": preprocessing.config["steps"] if preprocessing is not None else None,
+            "n": self.config['n'],
+            "hash_bits": self.hash_bits,
+            "min_count": self.config.get("min_count", 1),
+            "max_features": self.config.get("max_features", 0),
+            "parameters": self.parameters,
+            "train": util.hash_values(zip(X_train.index, X_train['sentence_version'], Y_train['dialect'])),
+        }
 
+    """
+    Collapses the per dialect models into a single linear model if all of them use a linear kernel and give
+    probability estimates: the weights of dialect i are the sum of its support vectors weighted by their
+    coefficients, rho its bias and probA, probB the parameters of the Platt sigmoid
+    """
+    def compile_weights(self, n_features: int) -> None:
+        if any(m.param.kernel_type != kernel_names.LINEAR or not m.is_probability_model() for m in self.models):
+            self.weights = None
+            return
+        self.weights = np.zeros((n_features, self.n))
+        self.rho = np.zeros(self.n)
+        self.prob_a = np.zeros(self.n)
+        self.prob_b = np.zeros(self.n)
+        self.first_labels = np.zeros(self.n, dtype=np.int64)
+        for i, m in enumerate(self.models):
+            coefficients = np.array([coef[0] for coef in m.get_sv_coef()])
+            for coefficient, support_vector in zip(coefficients, m.get_SV()):
+                # libsvm feature indices start at 1
+                indices = np.fromiter(support_vector.keys(), dtype=np.int64) - 1
+                values = np.fromiter(support_vector.values(), dtype=np.float64)
+                keep = indices < n_features
+                self.weights[indices[keep], i] += coefficient * values[keep]
+            self.rho[i] = m.rho[0]
+            self.prob_a[i] = m.probA[0]
+            self.prob_b[i] = m.probB[0]
+            self.first_labels[i] = m.label[0]
+
+    def store_weights(self, path: str) -> None:
+        np.savez(path, weights=self.weights, rho=self.rho, prob_a=self.prob_a, prob_b=self.prob_b, first_labels=self.first_labels)
 
-    def predict_dialect(self, row:dict, n:int) -> dict:
-        # encode x
-        x_encoded = self.encode_features(row, predict=True)
-        
-        # let each dialect svm predict a probability
-        probs = np.zeros((8))
+    """
+    Loads the weights stored by store_weights, returns False if there are none for a feature space of this size
+    """
+    def load_weights(self, path: str, n_features: int) -> bool:
+        if not os.path.exists(path):
+            return False
+        stored = np.load(path)
+        if stored['weights'].shape != (n_features, self.n):
+            print(f'Stored weights do not match {n_features} features and {self.n} dialects, ignoring {path}')
+            return False
+        self.weights = stored['weights']
+        self.rho = stored['rho']
+        self.prob_a = stored['prob_a']
+        self.prob_b = stored['prob_b']
+        self.first_labels = stored['first_labels']
+        return True
+
+
+
+
+    """
+    Gets an encoded feature matrix and returns the (rows x dialects) matrix of the probabilities of every
+    row belonging to a dialect, calling each dialect svm once for all rows
+    """
+    def predict_proba(self, X_encoded) -> np.ndarray:
+        if self.weights is not None:
+            return self.predict_proba_linear(X_encoded)
+        probs = np.zeros((X_encoded.shape[0], self.n))
         for i in range(0,self.n):
             # p_label seems to not really work, p_acc is not informative since we dont have verification here
-            p_label, p_acc, p_val = svm_predict([0], x_encoded, self.models[i], '-b 1 -q')
-            
+            p_label, p_acc, p_val = svm_predict([0] * X_encoded.shape[0], X_encoded, self.models[i], '-b 1 -q')
+
             # need to know in what order the svm encountered the 0/1 labels standiung for not/in dialect
-            # p_val contains class probabilities: [[P(x in dialect i), P(x not in dialect i)]]
+            # p_val contains class probabilities: [[P(x in dialect i), P(x not in dialect i)], ...]
             first_label_encountered = self.models[i].label[0]
-            if first_label_encountered == 0:
-                probs[i] = p_val[0][1]
-            else:
-                probs[i] = p_val[0][0]
-
-        
-        # predict class as the one with the highest confidence
-        p_label_index = np.argmax(probs)
-        # give back class as string
-        p_label = self.target_encoder.classes_[p_label_index]
+            column = 1 if first_label_encountered == 0 else 0
+            probs[:, i] = np.asarray(p_val)[:, column]
+        return probs
+
+    """
+    Same probabilities as predict_proba from the compiled weights with a single sparse matrix product.
+    Follows libsvm: the decision value is for the first label the model encountered, its probability is
+    the Platt sigmoid of the decision value clipped to [1e-7, 1 - 1e-7]
+    """
+    def predict_proba_linear(self, X_encoded) -> np.ndarray:
+        decision = X_encoded @ self.weights - self.rho
+        first_label_probs = np.clip(expit(-(decision * self.prob_a + self.prob_b)), 1e-7, 1 - 1e-7)
+        return np.where(self.first_labels == 0, 1 - first_label_probs, first_label_probs)
+
+    def predict_dialect(self, row:dict, n:int) -> dict:
+        # encode x
+        x_encoded = self.encode_features(row, predict=True)
 
+        # predict class as the one with the highest confidence and give it back as string
+        p_label_index = np.argmax(self.predict_proba(x_encoded)[0])
+        p_label = self.target_encoder.classes_[p_label_index]
 
         return p_label
 
 
+    """
+    Predicts the dialect of every row in df, in parallel chunks if n_workers is not 1
+    """
+    def predict(self, df):
+        n_workers = self.config.get("n_workers", 1)
+        if n_workers != 1:
+            return util.predict_parallel(self, df, n_workers)
+        return self.predict_rows(df)
+
+    """
+    Encodes all rows of df at once and predicts the dialect with the highest probability per row
+    """
+    def predict_rows(self, df):
+        if len(df.index) == 0:
+            return pd.Series(dtype=object, index=df.index)
+        probs = self.predict_proba(self.encode_features(df, predict=False))
+        return pd.Series(self.target_encoder.classes_[np.argmax(probs, axis=1)], index=df.index)
+
     """
     Main testing function of this model
     """
     def test(self) -> None:
         X_test, Y_test = self.dataset.get_test_data()
-        X_test.insert(0, 'dialect', Y_test.squeeze())
-        df = X_test
-        predictions = df.apply(lambda x: self.predict_dialect(x, self.config["n_eval"]), axis=1)
-        util.evaluate(df, predictions, self.dataset.config["dialects"])
+        predictions = self.predict(X_test)
+        util.evaluate(Y_test, predictions, self.dataset.config["dialects"])
 
     
\ No newline at end of file
@@ -2,77 +2,107 @@
 Implementation of different preprocessing steps and a wrapper class
 """
 
+import hashlib
+import json
 import pandas as pd
 import os
 import numpy as np
 
+from src.data.corpus import Corpus
 import src.utils.utils as util
 
 class DefaultPreprocessor():
     def __init__(self, config: dict) -> None:
         self.config = config
-        self.steps_store = [] # List with preprocessing steps that can be stored
-        self.steps_no_store = [] # Cannot load n-grams correctly, thus cannot be stored
-        self.path = "" # Used to build path where preprocessed data is stored/loaded
+        self.steps = []
+        n_grams = False # n-grams are always created last
         for step in self.config["steps"]:
             if step == "nGrams":
-                self.steps_no_store.append(self.create_n_grams)
+                n_grams = True
             elif step == "removeSymbols":
-                self.path += step + "_"
-                self.steps_store.append(self.remove_symbols)
+                self.steps.append(self.remove_symbols)
             elif step == "balance":
-                self.path += step + "_"
-                self.steps_store.append(self.balance)
+                self.steps.append(self.balance)
             elif step == "removeStopWords":
-                self.path += step + "_"
-                self.steps_store.append(self.remove_stop_words)
+                self.steps.append(self.remove_stop_words)
             else:
                 print("Invalid preprocessing step. Aborting")
                 raise NotImplementedError
-        self.path = self.path[:-1]
+        self.n_gram_step = n_grams
+        self.symbol_filter = util.compile_symbol_filter(self.config["symbols_to_remove"])
 
     def preprocess(self, raw_data: pd.DataFrame, datasetname: str) -> pd.DataFrame:
-        # First check if processed data already exists
-        path = self.config["processed_data_path"] + datasetname + "/" + self.path + ".csv"
-        data = None
-        if not self.config["no_load"]:
-            data = self.load_processed(path)
-        if data is None:
-            # If processed data does not exist, do preprocessing
-            data = raw_data
-            for step in self.steps_store:
-                data = step(data, datasetname)
-            # Save processed data if congfigured
-            if not self.config["no_store"]:
-                self.save_processed(path, data)
+        return self.preprocess_corpus(raw_data, datasetname).to_frame()
 
-        # Do preprocessing that cannot be loaded
-        for step in self.steps_no_store:
+    """
+    Runs the preprocessing steps and returns the processed data as a Corpus. The n-grams are passed to the corpus
+    as ids, no list of n-grams per row is created
+    """
+    def preprocess_corpus(self, raw_data: pd.DataFrame, datasetname: str) -> Corpus:
+        # First check if processed data already exists. The cache key hashes the raw data and the preprocessing config
+        cache = util.ArtifactCache(self.config["processed_data_path"] + datasetname)
+        description = self.get_cache_description(raw_data, datasetname)
+        key = cache.get_key(description)
+        path = os.path.join(cache.root, key, "data.npz")
+        if not self.config["no_load"] and cache.contains(key):
+            cache.touch(key)
+            return self.load_processed(path)
+
+        # If processed data does not exist, do preprocessing
+        data = raw_data
+        for step in self.steps:
             data = step(data, datasetname)
+        n_grams, n_gram_ids = self.create_n_grams(data) if self.n_gram_step else (None, None)
+        # Save processed data if congfigured
+        if not self.config["no_store"]:
+            cache.get_path(key)
+            self.save_processed(path, data, n_grams, n_gram_ids)
+            cache.store(key, description)
 
-        return data
+        return Corpus(data, n_grams, n_gram_ids)
 
-    # Load and safe preprocessed data
-    def load_processed(self, path) -> pd.DataFrame:
-        try:
-            data = pd.read_csv(path)
-            print("Load data from ", path)
-            return data
-        except FileNotFoundError:
-            return None
-
-    def save_processed(self, path, data: pd.DataFrame) -> None:
-        dir_path = path.rsplit('/', 1)[0]
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-        data.to_csv(path_or_buf=path, index=False)
+    """
+    Returns everything the processed data depends on: the dataset, a hash of the raw data and the preprocessing
+    config without the options of the cache itself
+    """
+    def get_cache_description(self, raw_data: pd.DataFrame, datasetname: str) -> dict:
+        return {
+            "dataset": datasetname,
+            "columns": raw_data.columns.tolist(),
+            "raw_data": hashlib.sha256(pd.util.hash_pandas_object(raw_data, index=True).values.tobytes()).hexdigest(),
+            "config": {key: value for key, value in self.config.items() if key not in ["processed_data_path", "no_store", "no_load"]},
+        }
+
+    """
+    Load and save preprocessed data as npz: every column as an array, the n-gram columns as the shared
+    vocabulary plus CSR-style (offsets, ids) arrays per n, thus the n-grams do not have to be extracted again
+    """
+    def load_processed(self, path) -> Corpus:
+        with np.load(path) as stored:
+            data = util.arrays_to_frame(stored)
+            n_grams, n_gram_ids = None, None
+            if "n_grams" in stored:
+                n_grams = np.array(stored["n_grams"].tolist(), dtype=object)
+                n_gram_ids = {n: (stored[f"offsets_{n}"], stored[f"ids_{n}"]) for n in stored["n"].tolist()}
+        print("Load data from ", path)
+        return Corpus(data, n_grams, n_gram_ids)
+
+    def save_processed(self, path, data: pd.DataFrame, n_grams: np.ndarray=None, n_gram_ids: dict=None) -> None:
+        arrays = util.frame_to_arrays(data, data.columns.tolist())
+        if n_gram_ids is not None:
+            arrays["n_grams"] = np.array(n_grams.tolist(), dtype=str)
+            arrays["n"] = np.array(list(n_gram_ids.keys()))
+            for n, (offsets, ids) in n_gram_ids.items():
+                arrays[f"offsets_{n}"] = offsets
+                arrays[f"ids_{n}"] = ids
+        np.savez(path, **arrays)
         print("Saved data to ", path)
 
 
     # Preprocessing steps
     # Every function should have the following structure:
     # def x(self, data: pd.DataFrame, datasetname: str) -> pd.DataFrame:
-    # If not, add case destinction in step loop in 'preprocess()'
+    # If not, add case destinction in step loop in 'preprocess_corpus()'
 
     """
     Removes the sentences where the dataset does not contain a translation in all languages.
@@ -91,70 +121,82 @@ class DefaultPreprocessor():
     Remove special symbols (defined in config) from sentences
     """
     def remove_symbols(self, data: pd.DataFrame, datasetname: str) -> pd.DataFrame:
-        data['sentence_version'] = data['sentence_version'].apply(lambda x: util.remove_from_sentence(x, self.config["symbols_to_remove"]))
+        data['sentence_version'] = util.filter_symbols(data['sentence_version'], self.symbol_filter)
         return data
 
     """
-    Create n grams for all n defined in config
+    Create n grams for all n defined in config. Lowercases the sentences and returns the n-grams of all orders
+    as the array of n-gram strings and the CSR-style (offsets, ids) per n of util.extract_n_gram_ids
     """
-    def create_n_grams(self, data: pd.DataFrame, datasetname: str, n_s=None) -> pd.DataFrame:
+    def create_n_grams(self, data: pd.DataFrame, n_s=None) -> tuple:
         if n_s is None:
             n_s = self.config["n"]
         data['sentence_version'] = data['sentence_version'].apply(lambda x: x.lower())
-        for n in n_s:
-            data[f'{n}_grams'] = data['sentence_version'].apply(lambda x: util.get_n_grams_sentence(x, n))
-        return data
+        # all orders are extracted in one pass into a single vocabulary
+        vocabulary = util.NGramVocabulary()
+        n_gram_ids = util.extract_n_gram_ids(data['sentence_version'], n_s, vocabulary)
+        return vocabulary.get_n_grams(), n_gram_ids
 
 
     """
-    Generate array of stopwords by removing words with a frequency over config['stopwords_threshold']
-    Then remove those words from dataset
+    Remove the stopwords of get_stop_words from dataset, in one pass over the words of every sentence. The
+    method is config["stopwords_method"] if not given. Stopword lists are cached per dataset and config
     """
-    def remove_stop_words(self, data: pd.DataFrame, datasetname: str, method='total') -> pd.DataFrame:
-        df_expl_words = data.copy()
-        # split sentence into list of words
-        df_expl_words['sentence_version'] = df_expl_words['sentence_version'].apply(lambda x: x.split(' '))
-        # explode list of words to multiple rows
-        df_expl_words = df_expl_words.explode('sentence_version').rename(columns={'sentence_version': 'word'})[['dialect', 'word']]
+    def remove_stop_words(self, data: pd.DataFrame, datasetname: str, method=None) -> pd.DataFrame:
+        if method is None:
+            method = self.config.get("stopwords_method", "total")
+        cache = util.ArtifactCache(self.config["processed_data_path"] + datasetname + "/stopwords")
+        description = {
+            "dataset": datasetname,
+            "data": hashlib.sha256(pd.util.hash_pandas_object(data[['dialect', 'sentence_version']], index=False).values.tobytes()).hexdigest(),
+            "method": method,
+            "threshold": self.config['stopwords_threshold_total'] if method == 'total' else self.config['stopwords_threshold_tf_idf'],
+        }
+        key = cache.get_key(description)
+        path = os.path.join(cache.root, key, "stopwords.json")
+        if not self.config["no_load"] and cache.contains(key):
+            cache.touch(key)
+            with open(path) as f:
+                stopwords = json.load(f)
+        else:
+            stopwords = self.get_stop_words(data, method)
+            if not self.config["no_store"]:
+                cache.get_path(key)
+                with open(path, "w") as f:
+                    json.dump(stopwords, f)
+                cache.store(key, description)
 
-        if method == 'total':
-            # count total occurences of each word
-            df_tot_occ = df_expl_words.groupby('word').size().sort_values(ascending=False).reset_index(name="count")
-            # remove words that occur to much
-            print(len(df_tot_occ['word']))
+        data['sentence_version'] = util.filter_tokens(data['sentence_version'], set(stopwords))
+        return data
 
-            df_tot_occ = df_tot_occ[df_tot_occ['count'] <= self.config['stopwords_threshold_total']]
-                        
-            print(len(df_tot_occ['word']))
+    """
+    Generate array of stopwords from the sparse (words x dialects) count matrix, dialects are the documents.
+        - 'total': words with a total frequency of at most config['stopwords_threshold_total']
+        - 'tfidf': words with a tf-idf of at most config['stopwords_threshold_tf_idf'] in any dialect, where tf is
+            the count of the word in the dialect divided by the maximum count in the dialect and idf the log of
+            the number of dialects divided by the number of dialects containing the word
+    """
+    def get_stop_words(self, data: pd.DataFrame, method='total') -> list:
+        words, counts = util.word_dialect_counts(data['sentence_version'], data['dialect'])
 
-            stopwords = df_tot_occ['word'].tolist()
+        if method == 'total':
+            totals = np.asarray(counts.sum(axis=1)).ravel()
+            stopwords = words[totals <= self.config['stopwords_threshold_total']]
 
         elif method == 'tfidf':
-            # count total occurences of each word per dialect
-            df_tot_occ_dial = df_expl_words.groupby(['word','dialect']).size().sort_values(ascending=False).reset_index(name="total_dial")
-
-            # find max term frequency per dialect
-            df_max_occ_dial = df_tot_occ_dial[['dialect', 'total_dial']].groupby('dialect').agg('max').rename(columns={'total_dial': 'max_dial'})
-
-            # merge into single df
-            df_tot_max_occ_dial = df_tot_occ_dial.merge(df_max_occ_dial, on='dialect')
-
-            # for each word and dialect calculate its term frequency
-            df_tot_max_occ_dial['tf'] = df_tot_max_occ_dial.apply(lambda x: x['total_dial']/x['max_dial'], axis=1)
-            print(df_tot_max_occ_dial.head())
-            df_tf_idf = df_tot_max_occ_dial[['word', 'dialect', 'tf']]
-
-            # calculate idf
-            df_num_dial = df_tot_max_occ_dial[['word', 'dialect']].groupby('word').size().reset_index(name='num_dial')
-            df_tf_idf['idf'] = np.log(9 / df_num_dial['num_dial'])
-
-            # merge into single df
-            df_tf_idf['tf_idf'] = df_tf_idf['tf'] * df_tf_idf['idf']
-            df_tf_idf = df_tf_idf.sort_values(by='tf_idf', ascending=False)
-
-            # use words with a high tf_idf frequency as stopwords
-            df_tf_idf = df_tf_idf[df_tf_idf['tf_idf'] <= self.config['stopwords_threshold_tf_idf']]
-            stopwords = df_tf_idf['word'].tolist()
-
-        data['sentence_version'] = data['sentence_version'].apply(lambda x: util.remove_from_sentence(x, stopwords))
-        return data
+            counts = counts.tocoo()
+            # tf per (word, dialect) pair, relative to the most frequent word of the dialect
+            max_dial = np.asarray(counts.max(axis=0).todense()).ravel()
+            tf = counts.data / max_dial[counts.col]
+            # idf per word, with the number of dialects as number of documents
+            num_dial = np.bincount(counts.row, minlength=counts.shape[0])
+            idf = np.log(counts.shape[1] / num_dial)
+            tf_idf = tf * idf[counts.row]
+            stopwords = words[np.unique(counts.row[tf_idf <= self.config['stopwords_threshold_tf_idf']])]
+
+        else:
+            print("Invalid stopwords method. Aborting")
+            raise NotImplementedError
+
+        print(f"{len(stopwords)} stopwords of {len(words)} words")
+        return stopwords.tolist()
@@ -1,5 +1,17 @@
+from collections import Counter, OrderedDict
+import hashlib
+import json
+from multiprocessing import Pool, get_context
+import os
+import re
+import shutil
+import time
+from zlib import crc32
 from nltk import ngrams
+import numpy as np
 import pandas as pd
+from scipy import sparse
+from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 
 """
 Gets word an returns all n-grams of size n in it.
@@ -23,6 +35,246 @@ def get_n_grams_sentence(sentence:str, n:int) -> list:
         n_grams += get_n_grams(i, n)
     return n_grams
 
+"""
+Maps n-grams of all orders to compact integer ids. N-grams of different orders never collide,
+thus a single vocabulary can be shared by all orders.
+"""
+class NGramVocabulary():
+    def __init__(self) -> None:
+        self.ids = {}
+        self.n_grams = np.empty(0, dtype=object)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, n_gram: str) -> bool:
+        return n_gram in self.ids
+
+    def get(self, n_gram: str) -> int:
+        return self.ids.get(n_gram, -1)
+
+    def add(self, n_gram: str) -> int:
+        return self.ids.setdefault(n_gram, len(self.ids))
+
+    def get_ids(self, n_grams: list) -> np.ndarray:
+        return np.array([self.ids.get(n_gram, -1) for n_gram in n_grams], dtype=np.int64)
+
+    def get_n_grams(self) -> np.ndarray:
+        # array of n-gram strings indexed by id
+        if len(self.n_grams) != len(self.ids):
+            self.n_grams = np.array(list(self.ids), dtype=object)
+        return self.n_grams
+
+"""
+Gets the n-gram lists of a set of sentences and returns how many sentences contain each n-gram
+"""
+def count_document_frequencies(n_grams_per_sentence: list) -> Counter:
+    frequencies = Counter()
+    for n_grams in n_grams_per_sentence:
+        frequencies.update(set(n_grams))
+    return frequencies
+
+"""
+Gets document frequencies of n-grams and returns a vocabulary of the n-grams occurring in at least min_count
+sentences. If max_features > 0, only the max_features most frequent of them are kept (ties broken by the
+n-gram). Ids are assigned in sorted n-gram order.
+"""
+def prune_vocabulary(frequencies: Counter, min_count: int=1, max_features: int=0) -> NGramVocabulary:
+    kept = [n_gram for n_gram, count in frequencies.items() if count >= min_count]
+    if max_features > 0 and len(kept) > max_features:
+        kept = sorted(kept, key=lambda n_gram: (-frequencies[n_gram], n_gram))[:max_features]
+    vocabulary = NGramVocabulary()
+    for n_gram in sorted(kept):
+        vocabulary.add(n_gram)
+    return vocabulary
+
+"""
+Maps n-grams into a fixed space of 2^bits buckets with a stable hash (crc32). Memory does not grow
+with the number of n-grams, but different n-grams may share a bucket.
+"""
+class HashedNGramVocabulary():
+    def __init__(self, bits: int) -> None:
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+
+    def __len__(self) -> int:
+        return 1 << self.bits
+
+    def __contains__(self, n_gram: str) -> bool:
+        return True
+
+    def get(self, n_gram: str) -> int:
+        return crc32(n_gram.encode()) & self.mask
+
+    def add(self, n_gram: str) -> int:
+        return self.get(n_gram)
+
+    def get_buckets(self, n_grams: list) -> np.ndarray:
+        return np.array([crc32(n_gram.encode()) & self.mask for n_gram in n_grams], dtype=np.int64)
+
+    def get_ids(self, n_grams: list) -> np.ndarray:
+        return self.get_buckets(n_grams)
+
+    # fraction of the given distinct n-grams that share their bucket with another n-gram
+    def get_collision_rate(self, n_grams: list) -> float:
+        buckets = self.get_buckets(set(n_grams))
+        if len(buckets) == 0:
+            return 0.0
+        _, inverse, counts = np.unique(buckets, return_inverse=True, return_counts=True)
+        return float(np.mean(counts[inverse] > 1))
+
+"""
+Vocabulary backed by a sorted array of n-grams, e.g. memory-mapped from a stored model. The id of an
+n-gram is its position in the array.
+"""
+class SortedNGramVocabulary():
+    def __init__(self, n_grams: np.ndarray) -> None:
+        self.n_grams = n_grams
+
+    def __len__(self) -> int:
+        return len(self.n_grams)
+
+    def __contains__(self, n_gram: str) -> bool:
+        return self.get(n_gram) >= 0
+
+    def get(self, n_gram: str) -> int:
+        return int(self.get_ids([n_gram])[0])
+
+    def get_ids(self, n_grams: list) -> np.ndarray:
+        n_grams = np.asarray(list(n_grams), dtype=str)
+        if len(self.n_grams) == 0 or len(n_grams) == 0:
+            return np.full(len(n_grams), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.n_grams, n_grams), len(self.n_grams) - 1)
+        return np.where(self.n_grams[positions] == n_grams, positions, -1)
+
+"""
+Gets a batch of sentences and extracts the n-grams of all orders in n_s in a single pass.
+Returns a dict mapping every n to CSR-style arrays (offsets, ids): the ids of the n-grams of
+sentence i are ids[offsets[i]:offsets[i+1]]. If grow is set, unseen n-grams are added to the
+vocabulary, otherwise they are dropped. A HashedNGramVocabulary maps every n-gram to its bucket.
+"""
+def extract_n_gram_ids(sentences: list, n_s: list, vocabulary: NGramVocabulary, grow: bool=True) -> dict:
+    ids = {n: [] for n in n_s}
+    offsets = {n: [0] for n in n_s}
+    table = getattr(vocabulary, "ids", None)
+    mask = getattr(vocabulary, "mask", None)
+    for sentence in sentences:
+        for word in sentence.split():
+            padded = ' ' + word + ' '
+            for n in n_s:
+                sentence_ids = ids[n]
+                for i in range(len(padded) - n + 1):
+                    n_gram = padded[i:i+n]
+                    if n_gram == " " or n_gram == "  ":
+                        continue
+                    if mask is not None:
+                        sentence_ids.append(crc32(n_gram.encode()) & mask)
+                    elif grow:
+                        sentence_ids.append(table.setdefault(n_gram, len(table)))
+                    elif n_gram in table:
+                        sentence_ids.append(table[n_gram])
+        for n in n_s:
+            offsets[n].append(len(ids[n]))
+    return {n: (np.array(offsets[n], dtype=np.int64), np.array(ids[n], dtype=np.int32)) for n in n_s}
+
+"""
+Gets the dialect of every sentence and their CSR-style n-gram ids and counts the n-grams per dialect and order.
+Returns compact count tables {dialect: {n: (keys, counts)}} where keys are n-gram strings or, for a
+HashedNGramVocabulary, bucket ids. Dialects not in dialect_list are skipped.
+"""
+def count_n_gram_ids(dialects: list, n_gram_ids: dict, vocabulary: object, dialect_list: list) -> dict:
+    dialect_index = {dialect: i for i, dialect in enumerate(dialect_list)}
+    codes = np.array([dialect_index.get(dialect, -1) for dialect in dialects], dtype=np.int64)
+    hashed = isinstance(vocabulary, HashedNGramVocabulary)
+    tables = {dialect: {} for dialect in dialect_list}
+    for n, (offsets, ids) in n_gram_ids.items():
+        id_codes = np.repeat(codes, np.diff(offsets))
+        for dialect, i in dialect_index.items():
+            unique_ids, counts = np.unique(ids[id_codes == i], return_counts=True)
+            keys = unique_ids if hashed else vocabulary.get_n_grams()[unique_ids]
+            tables[dialect][n] = (keys, counts)
+    return tables
+
+"""
+Counts the n-grams of a shard of sentences, see count_n_gram_ids. hash_bits > 0 uses a hashed vocabulary
+"""
+def count_n_grams(dialects: list, sentences: list, n_s: list, dialect_list: list, hash_bits: int=0) -> dict:
+    vocabulary = HashedNGramVocabulary(hash_bits) if hash_bits else NGramVocabulary()
+    n_gram_ids = extract_n_gram_ids(sentences, n_s, vocabulary)
+    return count_n_gram_ids(dialects, n_gram_ids, vocabulary, dialect_list)
+
+"""
+Splits the sentences into shards that are counted by a pool of n_workers processes (all cores if n_workers < 1).
+Returns the count tables of the shards in order, thus merging them is deterministic
+"""
+def count_n_grams_parallel(dialects: list, sentences: list, n_s: list, dialect_list: list, hash_bits: int=0, n_workers: int=0) -> list:
+    n_workers = n_workers if n_workers > 0 else os.cpu_count()
+    n_shards = min(4 * n_workers, max(len(sentences), 1))
+    bounds = np.linspace(0, len(sentences), n_shards + 1).astype(int)
+    shards = [(dialects[a:b], sentences[a:b], n_s, dialect_list, hash_bits) for a, b in zip(bounds[:-1], bounds[1:])]
+    with Pool(n_workers) as pool:
+        return pool.starmap(count_n_grams, shards)
+
+# model and data shared with the forked workers of predict_parallel
+_shared_prediction = None
+
+def _predict_chunk(start: int, end: int) -> pd.Series:
+    model, df = _shared_prediction
+    return model.predict_rows(df.iloc[start:end])
+
+"""
+Splits the rows of df into chunks that are predicted by a pool of n_workers forked processes (all cores if
+n_workers < 1) with model.predict_rows. The workers inherit the model and df copy-on-write instead of getting
+them pickled per task. Returns the predictions in the index order of df
+"""
+def predict_parallel(model: object, df: pd.DataFrame, n_workers: int=0) -> pd.Series:
+    global _shared_prediction
+    n_workers = n_workers if n_workers > 0 else os.cpu_count()
+    n_chunks = min(4 * n_workers, max(len(df.index), 1))
+    bounds = np.linspace(0, len(df.index), n_chunks + 1).astype(int)
+    _shared_prediction = (model, df)
+    try:
+        with get_context("fork").Pool(n_workers) as pool:
+            chunks = pool.starmap(_predict_chunk, zip(bounds[:-1], bounds[1:]))
+    finally:
+        _shared_prediction = None
+    return pd.concat(chunks)
+
+"""
+Gets CSR-style (offsets, ids) arrays and a mapping from ids to new ids. Returns the remapped arrays
+without the n-grams mapped to -1.
+"""
+def remap_n_gram_ids(offsets: np.ndarray, ids: np.ndarray, mapping: np.ndarray) -> tuple:
+    ids = mapping[ids]
+    keep = ids >= 0
+    kept_before = np.concatenate([[0], np.cumsum(keep)])
+    return kept_before[offsets], ids[keep]
+
+"""
+Gets CSR-style (offsets, ids) arrays and returns the sparse (n_sentences x n_columns) matrix
+counting how often each n-gram occurs in each sentence.
+"""
+def n_gram_id_matrix(offsets: np.ndarray, ids: np.ndarray, n_columns: int) -> sparse.csr_matrix:
+    matrix = sparse.csr_matrix((np.ones(len(ids)), ids, offsets), shape=(len(offsets) - 1, n_columns))
+    matrix.sum_duplicates()
+    return matrix
+
+"""
+Returns the positions of the k largest values in the order of np.argsort(-values, kind="stable")[:k], i.e. ties
+in ascending position, without sorting all values: the k largest are selected in linear time, only they are sorted
+"""
+def top_k(values: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(values))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k == 1:
+        return np.array([np.argmax(values)])
+    threshold = np.partition(values, len(values) - k)[len(values) - k]
+    larger = np.flatnonzero(values > threshold)
+    ties = np.flatnonzero(values == threshold)[:k - len(larger)]
+    selected = np.sort(np.concatenate([larger, ties]))
+    return selected[np.argsort(-values[selected], kind="stable")]
+
 """
 Gets a sentence and a list of symbols and removes all of them in it.
 """
@@ -32,6 +284,255 @@ def remove_from_sentence(sentence:str, symbols:list) -> str:
     return sentence
 
 
+"""
+Gets a list of symbols and returns compiled patterns that remove them like remove_from_sentence does, in order.
+Runs of single characters share one character class, which is faster than str.translate on non-ASCII text and
+removes the same as replacing them one by one. Longer symbols get a pattern each, since removing one symbol can join
+the text around it into an occurrence of a later one
+"""
+def compile_symbol_filter(symbols: list) -> list:
+    patterns = []
+    characters = ''
+    for symbol in dict.fromkeys(symbol for symbol in symbols if symbol):
+        if len(symbol) == 1:
+            characters += symbol
+            continue
+        if characters:
+            patterns.append(re.compile('[' + re.escape(characters) + ']'))
+            characters = ''
+        patterns.append(re.compile(re.escape(symbol)))
+    if characters:
+        patterns.append(re.compile('[' + re.escape(characters) + ']'))
+    return patterns
+
+"""
+Gets a series of sentences and the patterns of compile_symbol_filter and removes all their matches one after another
+"""
+def filter_symbols(sentences: pd.Series, patterns: list) -> pd.Series:
+    for pattern in patterns:
+        sentences = sentences.str.replace(pattern, '', regex=True)
+    return sentences
+
+"""
+Gets a series of sentences and a set of tokens and removes every word of a sentence that is in the set.
+Sentences are split on single spaces like in the rest of the pipeline
+"""
+def filter_tokens(sentences: pd.Series, tokens: set) -> pd.Series:
+    return pd.Series([' '.join([word for word in sentence.split(' ') if word not in tokens]) for sentence in sentences], index=sentences.index, dtype=object)
+
+"""
+Gets a series of sentences and their dialects and returns the array of distinct words (split on single spaces)
+and the sparse (words x dialects) matrix counting them per dialect. Dialects are ordered by first occurrence
+"""
+def word_dialect_counts(sentences: pd.Series, dialects: pd.Series) -> tuple:
+    dialect_codes, dialect_names = pd.factorize(dialects)
+    split = [sentence.split(' ') for sentence in sentences]
+    word_codes, words = pd.factorize(pd.Series([word for sentence_words in split for word in sentence_words], dtype=object))
+    word_dialects = np.repeat(dialect_codes, [len(sentence_words) for sentence_words in split])
+    counts = sparse.csr_matrix((np.ones(len(word_codes), dtype=np.int64), (word_codes, word_dialects)), shape=(len(words), len(dialect_names)))
+    return np.asarray(words, dtype=object), counts
+
+"""
+Converts the given columns (all if None) and the index of a DataFrame to a dict of numpy arrays that can be
+stored with np.savez without pickling. Object columns are stored as strings plus a mask of missing values
+"""
+def frame_to_arrays(data: pd.DataFrame, columns: list=None) -> dict:
+    columns = data.columns.tolist() if columns is None else columns
+    arrays = {
+        "columns": np.array(columns, dtype=str),
+        "object_columns": np.array([column for column in columns if data[column].dtype == object], dtype=str),
+        "index": data.index.values,
+    }
+    for column in columns:
+        values = data[column]
+        if values.dtype == object:
+            missing = values.isnull().values
+            arrays[f"column_{column}"] = np.array(values.where(~missing, '').tolist(), dtype=str)
+            if missing.any():
+                arrays[f"missing_{column}"] = missing
+        else:
+            arrays[f"column_{column}"] = values.values
+    return arrays
+
+"""
+Inverse of frame_to_arrays, gets the stored arrays (e.g. a loaded npz) and returns the DataFrame
+"""
+def arrays_to_frame(arrays) -> pd.DataFrame:
+    columns = arrays["columns"].tolist()
+    data = pd.DataFrame({column: arrays[f"column_{column}"] for column in columns}, index=arrays["index"])
+    for column in arrays["object_columns"].tolist():
+        data[column] = data[column].astype(object)
+        if f"missing_{column}" in arrays:
+            data.loc[arrays[f"missing_{column}"], column] = None
+    return data
+
+"""
+Binary cache of a parsed raw corpus, stored next to the raw file as <raw file>.parsed.npz together with the size
+and modification time of the raw file. Returns None if there is no cache or the raw file changed since
+"""
+def load_parsed_corpus(raw_data_path: str) -> pd.DataFrame:
+    path = raw_data_path + ".parsed.npz"
+    if not os.path.exists(path) or not os.path.exists(raw_data_path):
+        return None
+    stat = os.stat(raw_data_path)
+    with np.load(path) as stored:
+        if stored["source"].tolist() != [stat.st_size, stat.st_mtime_ns]:
+            return None
+        return arrays_to_frame(stored)
+
+def store_parsed_corpus(raw_data_path: str, data: pd.DataFrame) -> None:
+    stat = os.stat(raw_data_path)
+    arrays = frame_to_arrays(data)
+    arrays["source"] = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    try:
+        # write to a temporary file first, a concurrent reader must never see a partial cache
+        np.savez(raw_data_path + ".parsed.tmp.npz", **arrays)
+        os.replace(raw_data_path + ".parsed.tmp.npz", raw_data_path + ".parsed.npz")
+    except OSError as e:
+        print("Could not store the parsed corpus next to", raw_data_path, e)
+
+"""
+Gets a file containing a JSON array and yields its elements one by one, reading chunk_size characters at a time
+instead of loading the whole document. An element is only yielded once the ',' or ']' after it is read, until
+then it may be cut off at the end of a chunk (e.g. a number) and is decoded again with the next chunk
+"""
+def iter_json_array(f, chunk_size: int=1 << 20):
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[\s,]*')
+    delimiter = re.compile(r'\s*[,\]]')
+    buffer = f.read(chunk_size)
+    eof = not buffer
+    while not eof and not buffer.strip():
+        chunk = f.read(chunk_size)
+        buffer, eof = buffer + chunk, not chunk
+    buffer = buffer.lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("Expected a JSON array")
+    position = 1
+    while True:
+        position = whitespace.match(buffer, position).end()
+        if buffer.startswith(']', position):
+            return
+        error = None
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as e:
+            error = e
+        if error is not None or (not eof and not delimiter.match(buffer, end)):
+            # the element continues in the next chunk
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+                if error is not None:
+                    raise error
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield element
+        position = end
+
+"""
+Bounded least recently used cache. Counts hits and misses of get().
+"""
+class LRUCache():
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: object) -> object:
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: object, value: object) -> None:
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self) -> None:
+        self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+"""
+Gets an iterable of values and returns the sha256 hex digest of their string representations
+"""
+def hash_values(values) -> str:
+    digest = hashlib.sha256()
+    for value in values:
+        digest.update(str(value).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+"""
+Content-addressed cache of artifacts on disk. Every entry is a directory root/<key> where the key is a hash of
+everything the artifacts depend on. An entry is complete once store() wrote its manifest.json, incomplete
+directories are reused to resume. If there are more than max_entries complete entries, the least recently
+used ones are removed (0 keeps all)
+"""
+class ArtifactCache():
+    def __init__(self, root: str, max_entries: int=0) -> None:
+        self.root = root
+        self.max_entries = max_entries
+
+    def get_key(self, description: dict) -> str:
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def get_path(self, key: str) -> str:
+        path = os.path.join(self.root, key)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def get_manifest(self, key: str) -> str:
+        return os.path.join(self.root, key, "manifest.json")
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self.get_manifest(key))
+
+    # marks the entry as used for the eviction
+    def touch(self, key: str) -> None:
+        os.utime(self.get_manifest(key))
+
+    def store(self, key: str, description: dict) -> None:
+        with open(self.get_manifest(key), "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "description": description}, f, indent=4, sort_keys=True, default=str)
+        self.evict()
+
+    def evict(self) -> None:
+        if self.max_entries <= 0 or not os.path.isdir(self.root):
+            return
+        entries = [key for key in os.listdir(self.root) if self.contains(key)]
+        entries.sort(key=lambda key: os.path.getmtime(self.get_manifest(key)), reverse=True)
+        for key in entries[self.max_entries:]:
+            print("Evicting cached artifacts", os.path.join(self.root, key))
+            shutil.rmtree(os.path.join(self.root, key))
+
+
+"""
+Gets true_labels, predictions and dialects and returns accuracy and macro averaged precision, recall and f1
+without printing anything
+"""
+def get_metrics(true_labels: pd.DataFrame, predictions: pd.Series, dialects: list) -> dict:
+    actual = true_labels["dialect"]
+    predicted = predictions.loc[actual.index]
+    precision, recall, f1, _ = precision_recall_fscore_support(actual, predicted, labels=dialects, average="macro", zero_division=0)
+    return {
+        "accuracy": accuracy_score(actual, predicted),
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+    }
+
+
 """
 Gets true_labels, predictions and dialects and evaluates them:
 prints confusion matrix and precision, recall, f1, n_elems for each dialect
@@ -0,0 +1,65 @@
+"""
+Tests of the online mode of the adaptive HeLi model
+"""
+
+import random
+import pandas as pd
+
+from src.models.adaptive_heli import adaptive_Heli
+import src.utils.utils as util
+
+class Dataset():
+    def __init__(self) -> None:
+        self.config = {"dialects": ["ch_be", "ch_zh"]}
+
+    def get_train_data(self):
+        X = pd.DataFrame({"sentence_version": ["i bi dr hans", "ig bi de hans"]})
+        Y = pd.DataFrame({"dialect": ["ch_be", "ch_zh"]})
+        return X, Y
+
+def get_model(**config) -> adaptive_Heli:
+    model_config = {"n": [1, 2, 3], "n_eval": 3, "penalty_p": 5.8, "cache_size": 0, "online_decay": 0.99,
+                    "online_min_count": 0.5, "online_max_ngrams": 100000}
+    model_config.update(config)
+    model = adaptive_Heli(config=model_config, dataset=Dataset())
+    model.train()
+    return model
+
+def test_idle_adaptation_expires():
+    model = get_model()
+    model.adapt_online("qqxqq", "ch_be")
+    assert model.get_word_scores("qqxqq", 3)["ch_be"] < 5.8
+
+    # the adapted counts of ch_be decay while only ch_zh adapts
+    for _ in range(1000):
+        model.adapt_online("hans", "ch_zh")
+    assert model.get_word_scores("qqxqq", 3)["ch_be"] == 5.8
+    assert all(len(adapted) == 0 for adapted in model.adapted["ch_be"].values())
+    assert all(num == 0 for num in model.num_adapted["ch_be"].values())
+
+def test_adapted_counts_match_decay():
+    model = get_model()
+    decay, min_count = model.config["online_decay"], model.config["online_min_count"]
+    rng = random.Random(0)
+    # reference of the adapted counts: (dialect, nstring, n_gram) -> [count, step]
+    reference = {}
+    for step in range(1, 3001):
+        sentence = " ".join("".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(3))
+        dialect = rng.choice(["ch_be", "ch_zh"])
+        model.adapt_online(sentence, dialect)
+
+        reference = {key: entry for key, entry in reference.items() if entry[0] * decay ** (step - entry[1]) >= min_count}
+        for n in model.config["n"]:
+            for ngram in util.get_n_grams_sentence(sentence, n):
+                entry = reference.setdefault((dialect, f'{n}_grams', ngram), [0.0, step])
+                entry[0] = entry[0] * decay ** (step - entry[1]) + 1.0
+                entry[1] = step
+
+        assert sum(len(adapted) for orders in model.adapted.values() for adapted in orders.values()) == len(reference)
+        for (ref_dialect, nstring, ngram), (count, last) in reference.items():
+            adapted = model.adapted[ref_dialect][nstring][ngram]
+            assert adapted[1] == last
+            assert abs(adapted[0] - count) < 1e-9
+        for ref_dialect, orders in model.adapted.items():
+            for nstring, adapted in orders.items():
+                assert model.num_adapted[ref_dialect][nstring] == len([ngram for ngram in adapted if ngram not in model.counts[ref_dialect][nstring]])
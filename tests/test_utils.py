@@ -0,0 +1,36 @@
+"""
+Tests of the helpers in src/utils/utils.py
+"""
+
+import io
+import json
+import numpy as np
+import pandas as pd
+
+import src.utils.utils as util
+
+def test_iter_json_array_small_chunks():
+    documents = [
+        '[123, 456]',
+        '  [1,22,333]  ',
+        '[-7, 1.5e10, 0.25, true, false, null, "ab,]", {"a": [1, 22]}, [333]]',
+        '[]',
+    ]
+    for document in documents:
+        for chunk_size in [1, 2, 3, 5, 1 << 20]:
+            assert list(util.iter_json_array(io.StringIO(document), chunk_size)) == json.loads(document)
+
+def test_top_k_matches_stable_argsort():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        values = rng.integers(0, 5, size=rng.integers(1, 40)).astype(float)
+        values[rng.random(len(values)) < 0.2] = -np.inf
+        for k in [1, 2, 3, len(values) // 2, len(values), len(values) + 3]:
+            assert util.top_k(values, k).tolist() == np.argsort(-values, kind="stable")[:k].tolist()
+
+def test_filter_symbols_matches_sequential_replace():
+    sentences = pd.Series(["abb", "aab", "bac", "a.b,c", "äöü ab.", "", "babcc"])
+    for symbols in (["ab", "b"], ["b", "ab"], ["a", "bc"], [".", ",", "ä"], ["b", "a", "bc", "c", "b"], ["", "a"], []):
+        expected = sentences.apply(lambda x: util.remove_from_sentence(x, symbols))
+        filtered = util.filter_symbols(sentences, util.compile_symbol_filter(symbols))
+        assert filtered.equals(expected), symbols